@@ -3,12 +3,160 @@
 # A python interface for reading data from SDF file,
 # which is used by EPOCH, a PIC plasmas simulation code.
 
-import os, struct
+import os, io, struct, itertools, marshal, inspect, collections, threading, json, zlib, time, functools, contextlib, \
+        atexit, weakref, importlib
 import numpy as np
 
 
 idLen = 32  # Max length of ID strings in SDF.
 stringLen = 64  # Max length of strings in SDF.
+metadataCacheName = '.sdf_metadata_cache'  # Name of the metadata cache file kept in each sdf directory.
+metadataCacheVersion = 1  # Bumped whenever the layout of the metadata cache changes.
+chunkBytes = 1 << 24  # Default size of the pieces in which data areas are streamed.
+sliceGapBytes = 1 << 16  # Gaps smaller than this are read through, rather than seeked over, in partial reads.
+asyncWorkers = 8  # Threads doing the file I/O of the asynchronous calls (aget, aopen_dir).
+
+
+# Precompiled layouts of the headers in sdf files.
+# '=' stands for native byte order, standard sizes and no alignment, since fields are packed.
+SDF_HEADER_STRUCT = struct.Struct('=4s3i32s2q4id6i')  # 112 bytes of SDF header.
+SDF_BLOCK_HEADER_STRUCT = struct.Struct('=2q%dsq3i%dsi' % (idLen, stringLen))  # 136 bytes of block header.
+SDF_STRUCTS = {}  # Layouts of info areas, compiled on demand by sdfStruct.
+
+
+def sdfStruct(fmt):
+    # Returns the precompiled struct of a layout, compiling it on first use.
+    try:
+        return SDF_STRUCTS[fmt]
+    except KeyError:
+        SDF_STRUCTS[fmt] = struct.Struct('=' + fmt)
+        return SDF_STRUCTS[fmt]
+
+
+# The I/O statistics being kept, None if not profiling. See profileIO.
+ioStats = None
+
+
+def profiled(field):
+    # Decorates the methods of data objects and sdf files that read them,
+    # adding the time spent in them to the field of the I/O statistics when profiling.
+    # Calls made from within another profiled method are not counted again.
+    def decorate(method):
+        @functools.wraps(method)
+        def profiledMethod(self, *args, **kwargs):
+            stats = ioStats
+            if stats is None or getattr(stats.local, 'inside', False):
+                return method(self, *args, **kwargs)
+            stats.local.inside = True
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                stats.local.inside = False
+                if isinstance(self, _SDF):
+                    stats.count(self.FileName, 'header', **{field: time.time() - start})
+                else:
+                    stats.count(self.dataInfo['FileName'], self.dataInfo['blockTypeName'],
+                            **{field: time.time() - start})
+        return profiledMethod
+    return decorate
+
+
+# All reads of sdf files go through openSDF, readBytes, readArray and readInto,
+# which count them in the I/O statistics when profiling, under the name of the file
+# and blockTypeName, the type of the block read ('header' for headers and info areas).
+
+def openSDF(fileName, blockTypeName, raw = False):
+    # Open an sdf file for reading. With raw, the file is unbuffered, for readInto.
+    if raw:
+        f = io.open(fileName, 'rb', buffering = 0)
+    else:
+        f = open(fileName, 'rb')
+    stats = ioStats
+    if stats is not None:
+        stats.count(fileName, blockTypeName, opens = 1)
+    return f
+
+
+def readBytes(f, location, size, blockTypeName):
+    # Read size bytes from location, or from the current position if location is None.
+    stats = ioStats
+    if stats is not None:
+        start = time.time()
+    if location is not None:
+        f.seek(location)
+    data = f.read(size)
+    if stats is not None:
+        stats.count(f.name, blockTypeName, seeks = int(location is not None), reads = 1,
+                bytes = len(data), ioTime = time.time() - start)
+    return data
+
+
+def readArray(f, location, dataType, count, blockTypeName):
+    # Read count numbers of dataType from location, or from the current position if location is None.
+    stats = ioStats
+    if stats is not None:
+        start = time.time()
+    if location is not None:
+        f.seek(location)
+    data = np.fromfile(f, dtype = dataType, count = count)
+    if stats is not None:
+        stats.count(f.name, blockTypeName, seeks = int(location is not None), reads = 1,
+                bytes = data.nbytes, ioTime = time.time() - start)
+    return data
+
+
+def readInto(f, location, buf, blockTypeName):
+    # Read from location into buf, a writable buffer, until it's full or the file ends.
+    # Returns the number of bytes read.
+    stats = ioStats
+    if stats is not None:
+        start = time.time()
+    if location is not None:
+        f.seek(location)
+    pos = 0
+    reads = 0
+    while pos < len(buf):
+        n = f.readinto(buf[pos:])
+        reads += 1
+        if not n:
+            break
+        pos += n
+    if stats is not None:
+        stats.count(f.name, blockTypeName, seeks = int(location is not None), reads = reads,
+                bytes = pos, ioTime = time.time() - start)
+    return pos
+
+
+def threadMap(func, items, workers):
+    # map(func, items), run by a number of plain threads, each taking the next item when done with one.
+    # A multiprocessing ThreadPool isn't used, as shutting it down takes about 0.1 s in python 2.
+    # The first error raised by func is raised again, once all the threads are done.
+    items = list(items)
+    results = [None] * len(items)
+    positions = iter(xrange(len(items)))
+    positionLock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with positionLock:
+                i = next(positions, None)
+            if i is None or errors != []:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target = worker) for i in xrange(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors != []:
+        raise errors[0]
+    return results
 
 
 # ***
@@ -218,11 +366,168 @@ SDF_BLOCKTYPE = [
 ]
 
 
+# Reductions available to _searched_data.reduce, by name.
+# Each is (partial, combine, finalize): partial reduces a chunk of data,
+# combine merges two partial results, and finalize (if not None) turns
+# the merged result into the final value.
+SDF_REDUCTIONS = {
+    'sum': (lambda x: x.sum(dtype = np.float64), lambda a, b: a + b, None),
+    'sumsq': (lambda x: np.square(x, dtype = np.float64).sum(), lambda a, b: a + b, None),
+    'min': (np.min, min, None),
+    'max': (np.max, max, None),
+    'count': (lambda x: x.size, lambda a, b: a + b, None),
+    'mean': (lambda x: (x.sum(dtype = np.float64), x.size),
+            lambda a, b: (a[0] + b[0], a[1] + b[1]),
+            lambda r: r[0] / r[1]),
+    'rms': (lambda x: (np.square(x, dtype = np.float64).sum(), x.size),
+            lambda a, b: (a[0] + b[0], a[1] + b[1]),
+            lambda r: np.sqrt(r[0] / r[1])),
+}
+
+
+# Derived quantities, by block ID, registered by registerDerived.
+# Each sdf file gets a virtual block (of type SDF_BLOCKTYPE_PLAIN_DERIVED or
+# SDF_BLOCKTYPE_POINT_DERIVED) for each derived quantity whose input blocks it holds,
+# which can be searched by sd() like any other block.
+SDF_DERIVED = collections.OrderedDict()
+
+speedOfLight = 299792458.0  # In m/s.
+vacuumPermeability = 4.0e-7 * np.pi  # In H/m, as used by EPOCH.
+
+
+def registerDerived(blockID, inputs, func, blockName = None, units = '', deposit = False, regrid = None):
+    # Register a derived quantity.
+    # inputs are the block IDs of the variables it's derived from, and func computes the
+    # quantity from chunks of them, elementwise, eg. func(ex, ey, ez) = ex**2 + ey**2 + ez**2.
+    # '{species}' in blockID and inputs stands for any particle species in the file.
+    # If deposit is True, the inputs are point variables, func computes the weight of each
+    # particle from them, and the weights are deposited onto the cells of the grid block
+    # (nearest grid point), and divided by the cell volumes, giving a density.
+    # If regrid is 'centre' or 'node', the inputs are plain variables, which are first regridded
+    # there (see SDF_BLOCK_plain_variable.regrid), so that values at the same positions are combined.
+    if blockName is None:
+        blockName = 'Derived/' + blockID
+    SDF_DERIVED[blockID] = {'inputs': tuple(inputs), 'func': func, 'blockName': blockName,
+            'units': units, 'deposit': deposit, 'regrid': regrid}
+
+
+# The field components are staggered, so they're combined at the cell centres.
+registerDerived('e2', ['ex', 'ey', 'ez'], lambda ex, ey, ez: ex * ex + ey * ey + ez * ez,
+        'Derived/|E|^2', 'V^2/m^2', regrid = 'centre')
+registerDerived('b2', ['bx', 'by', 'bz'], lambda bx, by, bz: bx * bx + by * by + bz * bz,
+        'Derived/|B|^2', 'T^2', regrid = 'centre')
+registerDerived('poynting_x', ['ey', 'ez', 'by', 'bz'],
+        lambda ey, ez, by, bz: (ey * bz - ez * by) / vacuumPermeability, 'Derived/Poynting Flux/x', 'W/m^2',
+        regrid = 'centre')
+registerDerived('poynting_y', ['ez', 'ex', 'bz', 'bx'],
+        lambda ez, ex, bz, bx: (ez * bx - ex * bz) / vacuumPermeability, 'Derived/Poynting Flux/y', 'W/m^2',
+        regrid = 'centre')
+registerDerived('poynting_z', ['ex', 'ey', 'bx', 'by'],
+        lambda ex, ey, bx, by: (ex * by - ey * bx) / vacuumPermeability, 'Derived/Poynting Flux/z', 'W/m^2',
+        regrid = 'centre')
+
+
+def _kineticEnergy(px, py, pz, m):
+    # (gamma - 1) m c^2, written as p^2 c^2 / (E + m c^2) to avoid cancellation at low momenta.
+    p2c2 = (px * px + py * py + pz * pz) * speedOfLight ** 2
+    mc2 = m * speedOfLight ** 2
+    return p2c2 / (np.sqrt(p2c2 + mc2 * mc2) + mc2)
+
+
+registerDerived('ke/{species}', ['px/{species}', 'py/{species}', 'pz/{species}', 'mass/{species}'], _kineticEnergy,
+        'Derived/Kinetic Energy/{species}', 'J')
+registerDerived('number_density/{species}', ['weight/{species}'], lambda weight: weight,
+        'Derived/Number Density/{species}', '1/m^3', deposit = True)
+registerDerived('charge_density/{species}', ['weight/{species}', 'charge/{species}'],
+        lambda weight, charge: weight * charge,
+        'Derived/Charge Density/{species}', 'C/m^3', deposit = True)
+
+
 # --------------------------------------------------
 # sdf_block_data
 # This is the super class of all data type classes.
 
+class _data_info(object):
+    # The dataInfo of a data object, used as a dictionary.
+    # Items common to all blocks are looked up from the block header and the sdf file
+    # rather than stored, and only the items added by subclasses are kept, in self.extra.
+
+    __slots__ = ('data', 'extra')
+
+    getters = {
+        'FileName': lambda d: d.block.sdf.FileName,
+        'blockIndex': lambda d: d.block.blockNo - 1,
+        'time': lambda d: d.block.sdf.SDFHeader['time'],
+        'step': lambda d: d.block.sdf.SDFHeader['step'],
+        'dataLocation': lambda d: d.block.blockHeader.dataLocation,
+        'dataLen': lambda d: d.block.blockHeader.dataLen,
+        'dataType': lambda d: d.block.blockHeader.dataType,
+        'dataTypeName': lambda d: SDF_DATATYPE[d.block.blockHeader.dataType],
+        'dataTypeSize': lambda d: SDF_TYPE_SIZES[d.block.blockHeader.dataType],
+        'dataNumOfDimensions': lambda d: d.block.blockHeader.numberOfDimensions,
+        'blockType': lambda d: d.block.blockHeader.blockType,
+        'blockTypeName': lambda d: SDF_BLOCKTYPE[d.block.blockHeader.blockType],
+        'blockID': lambda d: d.block.blockHeader.blockID,
+        'blockName': lambda d: d.block.blockHeader.blockName,
+    }
+
+    def __init__(self, dataObj):
+        self.data = dataObj
+        self.extra = None
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return self.getters[key](self.data)
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.getters or (self.extra is not None and key in self.extra)
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        keys = self.getters.keys()
+        if self.extra is not None:
+            keys += [key for key in self.extra if not key in self.getters]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class sdf_block_data(object):
+    # Data objects are many, so they keep no per-instance dictionary.
+    __slots__ = ('block', 'blockInfo', 'dataInfo')
+
+    # dataInfoShowKeys decides which items of self.dataInfo will be displayed by self.show function.
+    # Extended by subclasses.
+    dataInfoShowKeys = ('blockName', 'blockID', 'blockTypeName',
+                        'dataNumOfDimensions', 'dataTypeName',
+                        'FileName', 'time', 'step')
+
     def __init__(self, parentObj, blockInfo):
         self.block = parentObj
 
@@ -231,34 +536,9 @@ class sdf_block_data(object):
         self.blockInfo = {}
 
         # self.dataInfo collects all useful information about the data area of a block.
-        # Part of its content is implemented by subclasses.
-        self.dataInfo = {}
-
-        # self.dataInfoShowKeys decides which items of self.dataInfo will be displayed by self.show function.
-        # Part of its content is implemented by subclasses.
-        self.dataInfoShowKeys = []
-        self.dataInfoShowKeys += ['blockName', 'blockID', 'blockTypeName',
-                                'dataNumOfDimensions', 'dataTypeName',
-                                'FileName', 'time', 'step']
-
-        self.p = self.quickPlot
-
-        self.dataInfo['FileName'] = self.block.FileName
-        self.dataInfo['blockIndex'] = self.block.blockIndex
-        self.dataInfo['time'] = self.block.sdf.SDFHeader['time']
-        self.dataInfo['step'] = self.block.sdf.SDFHeader['step']
-        self.dataInfo['dataLocation'] = self.block.blockHeader['dataLocation']
-        self.dataInfo['dataLen'] = self.block.blockHeader['dataLen']
-        dataType = self.block.blockHeader['dataType']
-        self.dataInfo['dataType'] = dataType
-        self.dataInfo['dataTypeName'] = SDF_DATATYPE[dataType]
-        self.dataInfo['dataTypeSize'] = SDF_TYPE_SIZES[dataType]
-        self.dataInfo['dataNumOfDimensions'] = self.block.blockHeader['numberOfDimensions']
-        blockType = self.block.blockHeader['blockType']
-        self.dataInfo['blockType'] = blockType
-        self.dataInfo['blockTypeName'] = SDF_BLOCKTYPE[blockType]
-        self.dataInfo['blockID'] = self.block.blockHeader['blockID']
-        self.dataInfo['blockName'] = self.block.blockHeader['blockName']
+        # The items common to all blocks come from the block header and the sdf file (see _data_info),
+        # the others are filled in by subclasses.
+        self.dataInfo = _data_info(self)
 
     def __repr__(self):
         return '<Data : %s : %s in %s>' % (self.dataInfo['blockName'], self.dataInfo['blockID'], self.dataInfo['FileName'])
@@ -275,6 +555,9 @@ class sdf_block_data(object):
         return self.get()
 
     def __getattr__(self, attrName):
+        # Only called for attributes not found otherwise, eg. a slot not yet set.
+        if attrName in sdf_block_data.__slots__:
+            raise AttributeError(attrName)
         return self.dataInfo[attrName]
 
     def show(self, full_info = False, full_path = False):
@@ -308,22 +591,254 @@ class sdf_block_data(object):
             reshape = [1]
         return tuple(reshape)
 
-    def retrieveData(self):
+    @profiled('dataTime')
+    def retrieveData(self, mmap = None):
         # Retrieve data in the data area of a block from the sdf file.
+        # In mmap mode, a read-only memory map over the data area is returned,
+        # so nothing is read from disk until the data is actually touched.
+        # mmap = None follows the mode of the file collection (see _d).
 
         dataLen = self.dataInfo['dataLen']
         if dataLen == 0:
             return np.arange(0.)
-        dataF = open(self.dataInfo['FileName'])
-        dataF.seek(self.dataInfo['dataLocation'])
-        dataStr = dataF.read(dataLen)
+        if mmap is None:
+            mmap = self.block.sdf.d.mmap
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        count = dataLen / dataType.itemsize
+        if mmap:
+            stats = ioStats
+            if stats is not None:
+                stats.count(self.dataInfo['FileName'], self.dataInfo['blockTypeName'], opens = 1)
+            return np.memmap(self.dataInfo['FileName'], dtype = dataType, mode = 'r',
+                    offset = self.dataInfo['dataLocation'], shape = (count,))
+        cache = dataCache
+        if cache is not None:
+            cacheKey = (self.dataInfo['FileName'], self.dataInfo['dataLocation'], dataLen,
+                    os.stat(self.dataInfo['FileName']).st_mtime)
+            data = cache.get(cacheKey)
+            if data is not None:
+                return data
+        readWorkers = self.block.sdf.d.readWorkers
+        if readWorkers is not None and readWorkers > 1 and dataLen > self.block.sdf.d.readChunkBytes:
+            data = self.retrieveInto(np.empty(count, dtype = dataType))
+        else:
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+            data = readArray(dataF, self.dataInfo['dataLocation'], dataType, count, self.dataInfo['blockTypeName'])
+            dataF.close()
+        if cache is not None:
+            cache.put(cacheKey, data)
+        return data
+
+    @profiled('dataTime')
+    def retrieveInto(self, data, workers = None, chunk_bytes = None):
+        # Read the whole data area into data, a preallocated contiguous array,
+        # without any intermediate copies.
+        # With several workers, the data area is split into ranges of chunk_bytes bytes,
+        # which are read at the same time by a pool of threads, each with its own file handle.
+        # workers and chunk_bytes default to the settings of the file collection (see _d).
+
+        dataLen = self.dataInfo['dataLen']
+        if dataLen == 0:
+            return data
+        if self.block.sdf.d.mmap:
+            data.reshape(-1)[...] = self.retrieveData(mmap = True)
+            return data
+        buf = memoryview(data.reshape(-1).view(np.uint8))
+        if len(buf) < dataLen:
+            raise ValueError('buffer of %d bytes is too small for %d bytes of data' % (len(buf), dataLen))
+        if workers is None:
+            workers = self.block.sdf.d.readWorkers
+        if chunk_bytes is None:
+            chunk_bytes = self.block.sdf.d.readChunkBytes
+
+        def readRanges(byteRanges):
+            # Read byte ranges taken from byteRanges, until it's exhausted, through one file handle.
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'], raw = True)
+            try:
+                while True:
+                    with rangeLock:
+                        byteRange = next(byteRanges, None)
+                    if byteRange is None:
+                        return
+                    start, stop = byteRange
+                    n = readInto(dataF, self.dataInfo['dataLocation'] + start, buf[start:stop], self.dataInfo['blockTypeName'])
+                    if n < stop - start:
+                        raise IOError('%s: data of %s ends early' % (self.dataInfo['FileName'], self.dataInfo['blockID']))
+            finally:
+                dataF.close()
+
+        rangeLock = threading.Lock()
+        byteRanges = [(start, min(start + chunk_bytes, dataLen)) for start in xrange(0, dataLen, chunk_bytes)]
+        if workers is not None and workers > 1 and len(byteRanges) > 1:
+            # Each thread opens the file once, and takes the next range whenever it's done with one.
+            # Plain threads are used as in threadMap.
+            workers = min(workers, len(byteRanges))
+            byteRanges = iter(byteRanges)
+            errors = []
+
+            def worker():
+                try:
+                    readRanges(byteRanges)
+                except Exception as err:
+                    errors.append(err)
+
+            threads = [threading.Thread(target = worker) for i in xrange(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors != []:
+                raise errors[0]
+        else:
+            readRanges(iter([(0, dataLen)]))
+        return data
+
+    # Shape of the array returned by self.get(), if it returns a single array.
+    # Can be rewrite by subclasses.
+    def dataShape(self, shapeReduction = True):
+        return (len(self),)
+
+    @profiled('dataTime')
+    def retrieveRange(self, start, count, dataF = None):
+        # Retrieve count numbers of the data area, beginning from the start-th number.
+        # An opened sdf file can be given as dataF to save the reopening.
+
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        if self.block.sdf.d.mmap:
+            return self.retrieveData(mmap = True)[start:(start + count)]
+        closeF = False
+        if dataF is None:
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+            closeF = True
+        data = readArray(dataF, self.dataInfo['dataLocation'] + start * dataType.itemsize, dataType, count,
+                self.dataInfo['blockTypeName'])
+        if closeF:
+            dataF.close()
+        return data
+
+    def iterData(self, chunk_bytes = None):
+        # Yield the data area piece by piece, as flat arrays of at most chunk_bytes bytes,
+        # so that it can be processed in bounded memory.
+
+        if chunk_bytes is None:
+            chunk_bytes = chunkBytes
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        count = len(self)
+        chunkLen = max(1, chunk_bytes / dataType.itemsize)
+        dataF = None
+        if not self.block.sdf.d.mmap:
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+        try:
+            readRange = self.rangeReader(dataF)
+            for start in xrange(0, count, chunkLen):
+                yield readRange(start, min(chunkLen, count - start))
+        finally:
+            if dataF is not None:
+                dataF.close()
+
+    # Returns a function of (start, count), which retrieves ranges of the data area
+    # as self.retrieveRange, for a pass over the data piece by piece through dataF.
+    # Can be rewrite by subclasses, eg. to compute once what each range is taken from.
+    def rangeReader(self, dataF = None):
+        return lambda start, count: self.retrieveRange(start, count, dataF)
+
+    @profiled('dataTime')
+    def retrieveSlab(self, shape, index):
+        # Retrieve part of the data area, which is seen as a C ordered array of the given shape.
+        # index can be made of integers, slices and Ellipsis, as in numpy basic indexing.
+        # Only the byte ranges covered by index are read from the sdf file.
+
+        ndim = len(shape)
+        if type(index) != type(()):
+            index = (index,)
+        if index.count(Ellipsis) > 1:
+            raise IndexError('an index can only have a single Ellipsis')
+        if Ellipsis in index:
+            i = index.index(Ellipsis)
+            index = index[:i] + (slice(None),) * (ndim - len(index) + 1) + index[(i + 1):]
+        if len(index) > ndim:
+            raise IndexError('too many indices for data of shape %r' % (tuple(shape),))
+        index = index + (slice(None),) * (ndim - len(index))
+
+        if self.block.sdf.d.mmap:
+            return self.retrieveData(mmap = True).reshape(shape)[index]
+
+        # Indices selected along each axis, and whether the axis is kept.
+        axisIndices = []
+        axisKept = []
+        for axisIndex, n in zip(index, shape):
+            if isinstance(axisIndex, slice):
+                axisIndices.append(np.arange(*axisIndex.indices(n)))
+                axisKept.append(True)
+            elif isinstance(axisIndex, (int, long, np.integer)):
+                if axisIndex < 0:
+                    axisIndex += n
+                if axisIndex < 0 or axisIndex >= n:
+                    raise IndexError('index %d is out of bounds for size %d' % (axisIndex, n))
+                axisIndices.append(np.array([axisIndex]))
+                axisKept.append(False)
+            else:
+                raise IndexError('only integers, slices and Ellipsis are valid indices')
+
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        data = np.empty([len(indices) for indices in axisIndices], dtype = dataType)
+        if data.size == 0:
+            return data.reshape([len(indices) for indices, kept in zip(axisIndices, axisKept) if kept])
+
+        # Trailing axes that are fully selected are stored continuously, and read as a whole.
+        fullAxis = ndim
+        while fullAxis > 0 and len(axisIndices[fullAxis - 1]) == shape[fullAxis - 1] \
+                and (axisIndices[fullAxis - 1] == np.arange(shape[fullAxis - 1])).all():
+            fullAxis -= 1
+        innerLen = int(np.prod(shape[fullAxis:]))
+        strides = [int(np.prod(shape[(axis + 1):])) for axis in range(ndim)]
+
+        dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+        if fullAxis == 0:
+            data[...] = self.retrieveRange(0, innerLen, dataF).reshape(data.shape)
+        else:
+            # Each selected row of innerLen values starts at a multiple of innerLen.
+            # Rows are sorted by offset and grouped into runs, over all the partially
+            # selected axes, as long as the gap between rows stays below sliceGapBytes
+            # and a run spans at most chunkBytes. Each run is read at once.
+            rowOffsets = 0
+            for axis in range(fullAxis):
+                shapeAxis = [1] * fullAxis
+                shapeAxis[axis] = -1
+                rowOffsets = rowOffsets + (axisIndices[axis] * strides[axis]).reshape(shapeAxis)
+            rowOffsets = np.asarray(rowOffsets, dtype = np.int64).ravel() / innerLen
+            order = np.argsort(rowOffsets, kind = 'mergesort')
+            ascending = rowOffsets[order]
+            rowBytes = innerLen * dataType.itemsize
+            gaps = (np.diff(ascending) - 1) * rowBytes
+            runBreaks = list(np.nonzero(gaps > sliceGapBytes)[0] + 1)
+            rows = data.reshape(-1, innerLen)
+            for start, stop in zip([0] + runBreaks, runBreaks + [len(ascending)]):
+                while start < stop:
+                    last = start + np.searchsorted(ascending[start:stop],
+                            ascending[start] + max(1, chunkBytes / rowBytes))
+                    first = ascending[start]
+                    runData = self.retrieveRange(first * innerLen,
+                            (ascending[last - 1] - first + 1) * innerLen, dataF)
+                    rows[order[start:last]] = \
+                            runData.reshape(-1, innerLen)[ascending[start:last] - first]
+                    start = last
         dataF.close()
-        return np.fromstring(dataStr, dtype = SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        return data.reshape([len(indices) for indices, kept in zip(axisIndices, axisKept) if kept])
 
     # Can be rewrite by subclasses.
     def get(self):
         return self.retrieveData()
 
+    def aget(self, callback = None):
+        # Asynchronous self.get(): returns at once a future (see _future) of the data,
+        # which are read by the threads of the asynchronous executor.
+        # Concurrent calls for the same data of the same file collection share a single read,
+        # while other collections may read them in another mode, eg. memory mapped.
+        # callback, if given, is called with the future once it's done.
+        key = ('get', id(self.block.sdf.d), self.dataInfo['FileName'], self.dataInfo['blockIndex'])
+        return submitAsync(key, self.get, callback)
+
     # Used by self.quickPlot.
     # Subclasses must rewrite this function if they want to provide quick data visualization.
     def getp(self):
@@ -342,6 +857,8 @@ class sdf_block_data(object):
         else:
             self.plainPlot(quickData)
 
+    p = quickPlot
+
     def pointPlot(self, quickData):
         numDim = len(quickData)
         if numDim == 1:
@@ -391,36 +908,34 @@ class sdf_block_data(object):
 # Data object do the following job:
 # 1. fill in self.blockInfo in class constructor.
 # 2. implement self.dataInfo in class constructor.
-# 3. implement self.dataInfoShowKeys in class constructor.
+# 3. extend dataInfoShowKeys as a class attribute.
 # 4. rewrite self.get() when necessary.
 # 5. rewrite self.getp() when necessary.
 
 class SDF_BLOCK_null(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_plain_mesh(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('units', 'labels', 'dims', 'minVal', 'maxVal', 'data_mesh_order')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
         ndims = self.dataInfo['dataNumOfDimensions']
-        self.blockInfo['mults'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['labels'] = []
-        for i in range(ndims):
-            self.blockInfo['labels'].append(blockInfo[0:32].strip())
-            blockInfo = blockInfo[32:]
-        self.blockInfo['units'] = []
-        for i in range(ndims):
-            self.blockInfo['units'].append(blockInfo[0:32].strip())
-            blockInfo = blockInfo[32:]
-        self.blockInfo['geometry'] = (struct.unpack('i', blockInfo[0:4]))[0]
-        blockInfo = blockInfo[4:]
-        self.blockInfo['minVal'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['maxVal'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['dims'] = struct.unpack('i' * ndims, blockInfo)
+        idFmt = ('%ds' % idLen) * ndims
+        info = sdfStruct('%dd%s%si%dd%dd%di' % (ndims, idFmt, idFmt, ndims, ndims, ndims)).unpack_from(blockInfo)
+        self.blockInfo['mults'] = info[0:ndims]
+        self.blockInfo['labels'] = [label.strip() for label in info[ndims:(2 * ndims)]]
+        self.blockInfo['units'] = [unit.strip() for unit in info[(2 * ndims):(3 * ndims)]]
+        self.blockInfo['geometry'] = info[3 * ndims]
+        self.blockInfo['minVal'] = info[(3 * ndims + 1):(4 * ndims + 1)]
+        self.blockInfo['maxVal'] = info[(4 * ndims + 1):(5 * ndims + 1)]
+        self.blockInfo['dims'] = info[(5 * ndims + 1):]
 
         self.dataInfo['geometry'] = self.blockInfo['geometry']
         self.dataInfo['geometryName'] = SDF_GEOMETRY[self.blockInfo['geometry']]
@@ -434,8 +949,6 @@ class SDF_BLOCK_plain_mesh(sdf_block_data):
         # data_mesh_order describes the order in which each dimesion of the mesh is represented
         self.dataInfo['data_mesh_order'] = '[x, y, z]'
 
-        self.dataInfoShowKeys += ['units', 'labels', 'dims', 'minVal', 'maxVal', 'data_mesh_order']
-
     def get(self):
         data = self.retrieveData()
         dataInDim = []
@@ -445,28 +958,27 @@ class SDF_BLOCK_plain_mesh(sdf_block_data):
         return dataInDim
 
 class SDF_BLOCK_point_mesh(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('units', 'labels', 'minVal', 'maxVal',
+            'numberOfPoints', 'speciesID',
+            'data_dimension_order', 'quickPlotSpecified')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
         ndims = self.dataInfo['dataNumOfDimensions']
-        self.blockInfo['mults'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['labels'] = []
-        for i in range(ndims):
-            self.blockInfo['labels'].append(blockInfo[0:32].strip())
-            blockInfo = blockInfo[32:]
-        self.blockInfo['units'] = []
-        for i in range(ndims):
-            self.blockInfo['units'].append(blockInfo[0:32].strip())
-            blockInfo = blockInfo[32:]
-        self.blockInfo['geometry'] = (struct.unpack('i', blockInfo[0:4]))[0]
-        blockInfo = blockInfo[4:]
-        self.blockInfo['minVal'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['maxVal'] = struct.unpack('d' * ndims, blockInfo[0:(8 * ndims)])
-        blockInfo = blockInfo[(8 * ndims):]
-        self.blockInfo['numberOfPoints'] = (struct.unpack('q', blockInfo[0:8]))[0]
-        self.blockInfo['speciesID'] = blockInfo[8:].strip()
+        idFmt = ('%ds' % idLen) * ndims
+        infoStruct = sdfStruct('%dd%s%si%dd%ddq' % (ndims, idFmt, idFmt, ndims, ndims))
+        info = infoStruct.unpack_from(blockInfo)
+        self.blockInfo['mults'] = info[0:ndims]
+        self.blockInfo['labels'] = [label.strip() for label in info[ndims:(2 * ndims)]]
+        self.blockInfo['units'] = [unit.strip() for unit in info[(2 * ndims):(3 * ndims)]]
+        self.blockInfo['geometry'] = info[3 * ndims]
+        self.blockInfo['minVal'] = info[(3 * ndims + 1):(4 * ndims + 1)]
+        self.blockInfo['maxVal'] = info[(4 * ndims + 1):(5 * ndims + 1)]
+        self.blockInfo['numberOfPoints'] = info[5 * ndims + 1]
+        self.blockInfo['speciesID'] = blockInfo[infoStruct.size:].strip()
 
         self.dataInfo['geometry'] = self.blockInfo['geometry']
         self.dataInfo['geometryName'] = SDF_GEOMETRY[self.blockInfo['geometry']]
@@ -485,26 +997,153 @@ class SDF_BLOCK_point_mesh(sdf_block_data):
         self.dataInfo['data_dimension_order'] = '[x, y, z]'
         self.dataInfo['quickPlotSpecified'] = 'points'
 
-        self.dataInfoShowKeys += ['units', 'labels', 'minVal', 'maxVal',
-                        'numberOfPoints', 'speciesID',
-                        'data_dimension_order', 'quickPlotSpecified']
-
     def get(self):
-        shape = (self.dataInfo['dataNumOfDimensions'], self.dataInfo['numberOfPoints'])
-        return self.retrieveData().reshape(shape)
+        return self.retrieveData().reshape(self.dataShape())
+
+    def dataShape(self, shapeReduction = True):
+        return (self.dataInfo['dataNumOfDimensions'], self.dataInfo['numberOfPoints'])
 
     def getp(self):
         return self.get()
 
+    def speciesVariables(self):
+        # Returns a dictionary of the point variables defined on this mesh, in the same file.
+        # The keys are the variable names, eg. 'px' for block ID 'px/electron'.
+        meshID = stripNull(self.dataInfo['blockID'])
+        variables = {}
+        for blockObj in self.block.sdf.blocks:
+            dataObj = blockObj.blockData
+            if isinstance(dataObj, SDF_BLOCK_point_variable) and stripNull(dataObj.dataInfo['meshID']) == meshID:
+                variables[stripNull(dataObj.dataInfo['blockID']).split('/')[0]] = dataObj
+        return variables
+
+    def iter_chunks(self, n, variables = None):
+        # Yield the points n at a time, as (coords, values).
+        # coords is an array of shape (dataNumOfDimensions, n) holding the coordinates,
+        # values is a list of arrays holding the matching values of the given variables.
+        # variables are point variable data objects of the same file, or names such as 'px'
+        # (see self.speciesVariables).
+        # Each piece is read with positioned reads, so memory is bounded by n.
+
+        if variables is None:
+            variables = []
+        speciesVariables = None
+        dataObjs = []
+        for variable in variables:
+            if type(variable) == type(''):
+                if speciesVariables is None:
+                    speciesVariables = self.speciesVariables()
+                if not variable in speciesVariables:
+                    raise KeyError('no variable %s on %s' % (variable, stripNull(self.dataInfo['blockID'])))
+                variable = speciesVariables[variable]
+            # The variables are read through the file handle of the mesh.
+            if not variable.dataInfo['FileName'] == self.dataInfo['FileName']:
+                raise ValueError('%r and %r are in different files' % (self, variable))
+            if not variable.dataInfo['numberOfPoints'] == self.dataInfo['numberOfPoints']:
+                raise ValueError('%r and %r differ in number of points' % (self, variable))
+            dataObjs.append(variable)
+
+        ndims = self.dataInfo['dataNumOfDimensions']
+        numberOfPoints = self.dataInfo['numberOfPoints']
+        dataF = None
+        if not self.block.sdf.d.mmap:
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+        try:
+            for start in xrange(0, numberOfPoints, n):
+                count = min(n, numberOfPoints - start)
+                coords = np.empty((ndims, count), dtype = SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+                for i in range(ndims):
+                    coords[i] = self.retrieveRange(i * numberOfPoints + start, count, dataF)
+                values = []
+                for dataObj in dataObjs:
+                    values.append(dataObj.retrieveRange(start, count, dataF))
+                yield coords, values
+        finally:
+            if dataF is not None:
+                dataF.close()
+
+    def select(self, where, columns = None, n = None):
+        # Select the points meeting a condition, eg. select(lambda x, px: (x > 0) & (px > 1e-22)).
+        # The arguments of where are named after the coordinates ('x', 'y', 'z')
+        # or the point variables of this mesh (see self.speciesVariables),
+        # and it returns a boolean array.
+        # columns names what to return, by default the coordinates;
+        # 'index' gives the indices of the selected points.
+        # Points are read n at a time, and only the selected values are kept,
+        # so memory scales with the selection rather than with the number of points.
+        # Returns a dictionary from column names to arrays.
+
+        ndims = self.dataInfo['dataNumOfDimensions']
+        numberOfPoints = self.dataInfo['numberOfPoints']
+        coordNames = ['x', 'y', 'z'][:ndims]
+        if columns is None:
+            columns = coordNames
+        if n is None:
+            n = max(1, chunkBytes / 8)
+        whereNames = inspect.getargspec(where).args
+        speciesVariables = self.speciesVariables()
+        for name in whereNames + list(columns):
+            if not (name in coordNames or name in speciesVariables or name == 'index'):
+                raise KeyError('no column %s on %s' % (name, stripNull(self.dataInfo['blockID'])))
+
+        dataF = None
+        if not self.block.sdf.d.mmap:
+            dataF = openSDF(self.dataInfo['FileName'], self.dataInfo['blockTypeName'])
+
+        def read(name, start, count):
+            if name == 'index':
+                return np.arange(start, start + count)
+            if name in coordNames:
+                return self.retrieveRange(coordNames.index(name) * numberOfPoints + start, count, dataF)
+            return speciesVariables[name].retrieveRange(start, count, dataF)
+
+        selected = dict([(name, []) for name in columns])
+        try:
+            for start in xrange(0, numberOfPoints, n):
+                count = min(n, numberOfPoints - start)
+                chunk = {}
+                for name in whereNames:
+                    chunk[name] = read(name, start, count)
+                mask = np.asarray(where(*[chunk[name] for name in whereNames]), dtype = bool)
+                indices = np.nonzero(mask)[0]
+                if len(indices) == 0:
+                    continue
+                for name in columns:
+                    if not name in chunk:
+                        chunk[name] = read(name, start, count)
+                    selected[name].append(chunk[name][indices])
+        finally:
+            if dataF is not None:
+                dataF.close()
+
+        for name in columns:
+            if selected[name] == []:
+                dataType = np.int64
+                if name in coordNames:
+                    dataType = SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']]
+                elif name in speciesVariables:
+                    dataType = SDF_TYPE_FOR_NUMPY[speciesVariables[name].dataInfo['dataType']]
+                selected[name] = np.array([], dtype = dataType)
+            else:
+                selected[name] = np.concatenate(selected[name])
+        return selected
+
 class SDF_BLOCK_plain_variable(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('units', 'meshID', 'dims',
+            'data_order_c', 'data_shape_c', 'data_shape_c_reduced')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-        self.blockInfo['mults'] = (struct.unpack('d', blockInfo[0:8]))[0]
-        self.blockInfo['units'] = blockInfo[8:40].strip()
-        self.blockInfo['meshID'] = blockInfo[40:72].strip()
-        self.blockInfo['dims'] = struct.unpack('i' * (len(blockInfo[72:-4]) / 4), blockInfo[72:(len(blockInfo) - 4)])
-        self.blockInfo['stagger'] = (struct.unpack('i', blockInfo[-4:]))[0]
+        ndims = (len(blockInfo) - 76) / 4
+        info = sdfStruct('d%ds%ds%dii' % (idLen, idLen, ndims)).unpack_from(blockInfo)
+        self.blockInfo['mults'] = info[0]
+        self.blockInfo['units'] = info[1].strip()
+        self.blockInfo['meshID'] = info[2].strip()
+        self.blockInfo['dims'] = info[3:-1]
+        self.blockInfo['stagger'] = info[-1]
 
         self.dataInfo['stagger'] = self.blockInfo['stagger']
         self.dataInfo['staggerName'] = SDF_STAGGER[self.blockInfo['stagger']]
@@ -529,122 +1168,594 @@ class SDF_BLOCK_plain_variable(sdf_block_data):
         self.dataInfo['data_shape_c'] = self.dataInfo['data_shape'][::-1]
         self.dataInfo['data_shape_c_reduced'] = self.dataInfo['data_shape_reduced'][::-1]
 
-        self.dataInfoShowKeys += ['units', 'meshID', 'dims',
-                                'data_order_c', 'data_shape_c', 'data_shape_c_reduced']
-
     def get(self, shapeReduction = True):
-        shape = self.dataInfo['data_shape_c']
+        return self.retrieveData().reshape(self.dataShape(shapeReduction), order = 'C')
+
+    def dataShape(self, shapeReduction = True):
         if shapeReduction:
-            shape = self.dataInfo['data_shape_c_reduced']
-        return self.retrieveData().reshape(shape, order = 'C')
+            return self.dataInfo['data_shape_c_reduced']
+        return self.dataInfo['data_shape_c']
 
     def getp(self):
         return self.get(True)
 
+    def __getitem__(self, index):
+        # Partial read, eg. data[..., 100:200, ::4].
+        # The index applies to the array returned by self.get(),
+        # but only the needed parts of the data area are read.
+        return self.retrieveSlab(self.dataInfo['data_shape_c_reduced'], index)
+
+    def read_box(self, lo, hi):
+        # Read the values of cells lo[d] <= i < hi[d] along each dimension d, given in [x, y, z] order,
+        # eg. the domain of a rank from SDF_BLOCK_cpu_split.domains().
+        # Returns an array in C order, ie. [z, y, x], keeping all the dimensions.
+        # Only the strided byte ranges of the box are read, see self.retrieveSlab.
+        dims = self.dataInfo['dims']
+        if not (len(lo) == len(dims) and len(hi) == len(dims)):
+            raise ValueError('box bounds should have %d dimensions' % len(dims))
+        index = tuple([slice(int(l), min(int(h), n)) for l, h, n in zip(lo, hi, dims)][::-1])
+        return self.retrieveSlab(self.dataInfo['data_shape_c'], index)
+
+    def read_rank(self, rank, cpu = None):
+        # Read the domain of an MPI rank, numbered as in SDF_BLOCK_cpu_split.domains(),
+        # from the cpu_split block cpu (its data object or block ID),
+        # by default the first cpu_split block in the same file.
+        # Staggered values beyond the last cell belong to the ranks at the upper edges,
+        # so that each value is read for exactly one rank.
+        if cpu is None:
+            for blockObj in self.block.sdf.blocks:
+                if isinstance(blockObj.blockData, SDF_BLOCK_cpu_split):
+                    cpu = blockObj.blockData
+                    break
+            else:
+                raise KeyError('no cpu_split block in %s' % self.dataInfo['FileName'])
+        elif isinstance(cpu, basestring):
+            blockID = cpu
+            cpu = self.block.sdf.findData(blockID)
+            if not isinstance(cpu, SDF_BLOCK_cpu_split):
+                raise KeyError('no cpu_split block %s in %s' % (blockID, self.dataInfo['FileName']))
+        lo, hi = cpu.domains()
+        if not 0 <= rank < len(lo):
+            raise IndexError('rank %d is out of range for %d ranks' % (rank, len(lo)))
+        cells = np.array([bounds[-1] for bounds in cpu.get()])
+        hi = np.where(hi[rank] == cells, np.maximum(hi[rank], self.dataInfo['dims']), hi[rank])
+        return self.read_box(lo[rank], hi)
+
+    def regridIndices(self, axis, cells, to):
+        # How to regrid along a dimension (in [x, y, z] order) of cells cells, to 'centre' or 'node'.
+        # Bit axis of the stagger tells whether the values are on the nodes along it, or else
+        # on the cell centres. Values on the nodes may leave out the first node, as EPOCH writes them.
+        # Returns (indices, average): the values at indices, along the dimension, are taken,
+        # and with average, each two neighbours are then averaged. indices is None if nothing is to be done.
+        # At the edges, the nearest values are taken.
+        n = self.dataInfo['dims'][axis]
+        atNode = (self.dataInfo['stagger'] >> axis) & 1
+        if not (n == cells or (atNode and n == cells + 1)):
+            raise ValueError('%s has %d values along dimension %d, which has %d cells'
+                    % (stripNull(self.dataInfo['blockID']), n, axis, cells))
+        if to == 'centre':
+            if not atNode:
+                return None, False
+            if n == cells + 1:
+                return np.arange(n), True
+            return np.concatenate(([0], np.arange(n))), True
+        if atNode:
+            if n == cells + 1:
+                return None, False
+            return np.concatenate(([0], np.arange(n))), False
+        return np.concatenate(([0], np.arange(n), [n - 1])), True
+
+    def regridPlan(self, to):
+        # Returns the regridding along each axis in C order (see self.regridIndices),
+        # and the shape and type of the regridded array.
+        if not to in ('centre', 'node'):
+            raise ValueError('to should be \'centre\' or \'node\', not %r' % (to,))
+        mesh = self.block.sdf.findData(stripNull(self.dataInfo['meshID']))
+        if not isinstance(mesh, SDF_BLOCK_plain_mesh):
+            raise KeyError('no plain mesh %s in %s' % (self.dataInfo['meshID'], self.dataInfo['FileName']))
+        cells = [dim - 1 for dim in mesh.dataInfo['dims']]
+        ndims = len(self.dataInfo['dims'])
+
+        axisRegrid = [self.regridIndices(ndims - 1 - axis, cells[ndims - 1 - axis], to) for axis in range(ndims)]
+        outShape = []
+        for (indices, average), n in zip(axisRegrid, self.dataInfo['data_shape_c']):
+            if indices is None:
+                outShape.append(n)
+            else:
+                outShape.append(len(indices) - int(average))
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        return axisRegrid, tuple(outShape), np.promote_types(dataType, np.float32)
+
+    def iter_regrid(self, to = 'centre', rows = None):
+        # Regrid the values to the cell centres ('centre') or the nodes ('node') of the mesh,
+        # by averaging neighbours along the dimensions in which the stagger differs.
+        # Yields (start, slab), slabs of at most rows rows of the regridded array in C order,
+        # ie. [z, y, x], beginning at row start. Each slab is computed from the rows it needs only,
+        # so memory is bounded by a few slabs. rows defaults to what fits in chunkBytes.
+        axisRegrid, outShape, outType = self.regridPlan(to)
+        shape = self.dataInfo['data_shape_c']
+        ndims = len(shape)
+        if rows is None:
+            rows = max(1, chunkBytes / max(1, int(np.prod(outShape[1:])) * outType.itemsize))
+
+        def regridAxis(data, axis, indices, average):
+            if indices is None:
+                return data
+            data = np.take(data, indices, axis = axis)
+            if not average:
+                return data
+            lower = [slice(None)] * data.ndim
+            upper = [slice(None)] * data.ndim
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            return (data[tuple(lower)] + data[tuple(upper)]) * 0.5
+
+        indices, average = axisRegrid[0]
+        if indices is None:
+            indices = np.arange(shape[0])
+        for start in xrange(0, outShape[0], rows):
+            stop = min(start + rows, outShape[0])
+            # The rows of the data needed by output rows start to stop.
+            needed = indices[start:(stop + int(average))]
+            first, last = needed.min(), needed.max() + 1
+            slab = self.retrieveSlab(shape, (slice(first, last),)).astype(outType, copy = False)
+            slab = regridAxis(slab, 0, needed - first, average)
+            for axis in range(1, ndims):
+                slab = regridAxis(slab, axis, *axisRegrid[axis])
+            yield start, slab
+
+    def regrid(self, to = 'centre', rows = None):
+        # Returns the values regridded to the cell centres or the nodes of the mesh,
+        # in C order, ie. [z, y, x]. See self.iter_regrid.
+        axisRegrid, outShape, outType = self.regridPlan(to)
+        data = np.empty(outShape, dtype = outType)
+        for start, slab in self.iter_regrid(to, rows):
+            data[start:(start + len(slab))] = slab
+        return data
+
 class SDF_BLOCK_point_variable(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('units', 'meshID', 'numberOfPoints', 'speciesID')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-        self.blockInfo['mults'] = (struct.unpack('d', blockInfo[0:8]))[0]
-        self.blockInfo['units'] = blockInfo[8:40].strip()
-        self.blockInfo['meshID'] = blockInfo[40:72].strip()
-        self.blockInfo['numberOfPoints'] = (struct.unpack('q', blockInfo[72:80]))[0]
-        self.blockInfo['speciesID'] = blockInfo[80:].strip()
+        infoStruct = sdfStruct('d%ds%dsq' % (idLen, idLen))
+        info = infoStruct.unpack_from(blockInfo)
+        self.blockInfo['mults'] = info[0]
+        self.blockInfo['units'] = info[1].strip()
+        self.blockInfo['meshID'] = info[2].strip()
+        self.blockInfo['numberOfPoints'] = info[3]
+        self.blockInfo['speciesID'] = blockInfo[infoStruct.size:].strip()
 
         self.dataInfo['units'] = self.blockInfo['units']
         self.dataInfo['meshID'] = self.blockInfo['meshID']
         self.dataInfo['numberOfPoints'] = self.blockInfo['numberOfPoints']
         self.dataInfo['speciesID'] = self.blockInfo['speciesID']
 
-        self.dataInfoShowKeys += ['units', 'meshID', 'numberOfPoints', 'speciesID']
+    def iter_chunks(self, n):
+        # Yield the values n points at a time.
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[self.dataInfo['dataType']])
+        return self.iterData(n * dataType.itemsize)
 
 class SDF_BLOCK_constant(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('constValue',)
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
         varTypeStruct = SDF_TYPE_FOR_STRUCT[self.dataInfo['dataType']]
         varLen = len(blockInfo) / SDF_TYPE_SIZES[self.dataInfo['dataType']]
-        self.blockInfo['constValue'] = struct.unpack(varTypeStruct * varLen, blockInfo)
+        self.blockInfo['constValue'] = sdfStruct(varTypeStruct * varLen).unpack_from(blockInfo)
 
         self.dataInfo['constValue'] = self.blockInfo['constValue']
 
-        self.dataInfoShowKeys += ['constValue']
 
 class SDF_BLOCK_array(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_run_info(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-        self.blockInfo['version'] = (struct.unpack('i', blockInfo[0:4]))[0]
-        self.blockInfo['revision'] = (struct.unpack('i', blockInfo[4:8]))[0]
-        self.blockInfo['commitID'] = blockInfo[8:72].strip()
-        self.blockInfo['sha1sum'] = blockInfo[72:136].strip()
-        self.blockInfo['compileMachine'] = blockInfo[136:200].strip()
-        self.blockInfo['compileFlags'] = blockInfo[200:264].strip()
-        self.blockInfo['defines'] = (struct.unpack('q', blockInfo[264:272]))[0]
-        self.blockInfo['compileDate'] = (struct.unpack('i', blockInfo[272:276]))[0]
-        self.blockInfo['runDate'] = (struct.unpack('i', blockInfo[276:280]))[0]
-        self.blockInfo['ioDate'] = (struct.unpack('i', blockInfo[280:284]))[0]
-        self.blockInfo['minorRevision'] = (struct.unpack('i', blockInfo[284:288]))[0]
+        info = sdfStruct('2i%sq4i' % (('%ds' % stringLen) * 4)).unpack_from(blockInfo)
+        self.blockInfo['version'] = info[0]
+        self.blockInfo['revision'] = info[1]
+        self.blockInfo['commitID'] = info[2].strip()
+        self.blockInfo['sha1sum'] = info[3].strip()
+        self.blockInfo['compileMachine'] = info[4].strip()
+        self.blockInfo['compileFlags'] = info[5].strip()
+        self.blockInfo['defines'] = info[6]
+        self.blockInfo['compileDate'] = info[7]
+        self.blockInfo['runDate'] = info[8]
+        self.blockInfo['ioDate'] = info[9]
+        self.blockInfo['minorRevision'] = info[10]
 
 class SDF_BLOCK_source(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-class SDF_BLOCK_stitched_tensor(sdf_block_data):
+class sdf_stitched_data(sdf_block_data):
+    # The super class of the blocks combining several variables into one,
+    # eg. the components of a vector field, or a variable of several species.
+    # Stitched blocks only refer to the variable blocks, by ID,
+    # while contiguous blocks also hold the data of all the variables in their own data area.
+    # The number of variables is given as the number of dimensions in the block header.
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('meshID', 'variableIDs')
+
+    contiguous = False
+
+    def parseInfo(self, blockInfo, fmt, names = False):
+        # Unpack the info area, made of the fields of fmt, followed by the IDs of the variables,
+        # or if names is True, by the names of the variables (stringLen each) and then their IDs.
+        # Returns the fields of fmt, followed by the names if any.
+        fixedSize = sdfStruct(fmt).size
+        variableSize = idLen
+        if names:
+            variableSize += stringLen
+        numVariables = min(self.dataInfo['dataNumOfDimensions'], (len(blockInfo) - fixedSize) / variableSize)
+        if names:
+            fmt += ('%ds' % stringLen) * numVariables
+        info = sdfStruct(fmt + ('%ds' % idLen) * numVariables).unpack_from(blockInfo)
+        fields = info[:(len(info) - numVariables)]
+        self.blockInfo['meshID'] = stripNull(fields[1])
+        self.blockInfo['variableIDs'] = [stripNull(variableID) for variableID in info[len(fields):]]
+        self.dataInfo['meshID'] = self.blockInfo['meshID']
+        self.dataInfo['variableIDs'] = self.blockInfo['variableIDs']
+        return fields
+
+    def variables(self):
+        # Returns the data objects of the variables, in order.
+        variables = []
+        for variableID in self.dataInfo['variableIDs']:
+            dataObj = self.block.sdf.findData(variableID)
+            if dataObj is None:
+                raise KeyError('no variable %s of %s in %s' % (variableID, stripNull(self.dataInfo['blockID']),
+                        self.dataInfo['FileName']))
+            variables.append(dataObj)
+        return variables
+
+    def dataShape(self, shapeReduction = True):
+        # (number of variables, ...shape of each variable).
+        numVariables = len(self.dataInfo['variableIDs'])
+        if numVariables == 0:
+            return (0,)
+        if self.contiguous:
+            count = len(self) / numVariables
+            first = self.block.sdf.findData(self.dataInfo['variableIDs'][0])
+            if first is not None and int(np.prod(first.dataShape(shapeReduction))) == count:
+                return (numVariables,) + tuple(first.dataShape(shapeReduction))
+            return (numVariables, count)
+        return (numVariables,) + tuple(self.variables()[0].dataShape(shapeReduction))
+
+    def get(self, shapeReduction = True):
+        # Returns the variables stacked into one array of shape (number of variables, ...).
+        # Contiguous blocks are memory mapped as a whole, so nothing is read or copied until used.
+        # For stitched blocks, one array is allocated and the data area of each variable is read into it.
+        shape = self.dataShape(shapeReduction)
+        if self.contiguous:
+            return self.retrieveData(mmap = True).reshape(shape)
+        variables = self.variables()
+        dataType = variables[0].dataInfo['dataType']
+        for dataObj in variables:
+            if not (dataObj.dataInfo['dataType'] == dataType
+                    and tuple(dataObj.dataShape(shapeReduction)) == shape[1:]):
+                raise ValueError('%r and %r differ in type or shape, cannot be stitched' % (variables[0], dataObj))
+        return self.retrieveInto(np.empty(shape, dtype = SDF_TYPE_FOR_NUMPY[dataType]))
+
+    def retrieveInto(self, data, workers = None, chunk_bytes = None):
+        # Stitched blocks read the data area of each variable into its own part of data.
+        if self.contiguous:
+            return sdf_block_data.retrieveInto(self, data, workers, chunk_bytes)
+        for part, dataObj in zip(data.reshape(len(self.dataInfo['variableIDs']), -1), self.variables()):
+            if part.dtype == SDF_TYPE_FOR_NUMPY[dataObj.dataInfo['dataType']]:
+                dataObj.retrieveInto(part, workers, chunk_bytes)
+            else:
+                part[...] = dataObj.get().reshape(-1)
+        return data
+
+class SDF_BLOCK_stitched_tensor(sdf_stitched_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_stitched_data.dataInfoShowKeys + ('staggerName',)
+
     def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+        sdf_stitched_data.__init__(self, parentObj, blockInfo)
+
+        fields = self.parseInfo(blockInfo, 'i%ds' % idLen)
+        self.blockInfo['stagger'] = fields[0]
+        self.dataInfo['stagger'] = self.blockInfo['stagger']
+        if 0 <= self.blockInfo['stagger'] < len(SDF_STAGGER):
+            self.dataInfo['staggerName'] = SDF_STAGGER[self.blockInfo['stagger']]
+        else:
+            self.dataInfo['staggerName'] = ''
 
 class SDF_BLOCK_stitched_material(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_stitched_matvar(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-class SDF_BLOCK_stitched_species(sdf_block_data):
+class SDF_BLOCK_stitched_species(sdf_stitched_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_stitched_data.dataInfoShowKeys + ('staggerName', 'materialID', 'materialName',
+            'speciesNames')
+
     def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+        sdf_stitched_data.__init__(self, parentObj, blockInfo)
+
+        # The info area holds the stagger, mesh ID, material ID and name,
+        # then the name of the species of each variable, and the variable IDs.
+        fields = self.parseInfo(blockInfo, 'i%ds%ds%ds' % (idLen, idLen, stringLen), names = True)
+        self.blockInfo['stagger'] = fields[0]
+        self.blockInfo['materialID'] = stripNull(fields[2])
+        self.blockInfo['materialName'] = stripNull(fields[3])
+        self.blockInfo['speciesNames'] = [stripNull(speciesName) for speciesName in fields[4:]]
+        self.dataInfo['stagger'] = self.blockInfo['stagger']
+        if 0 <= self.blockInfo['stagger'] < len(SDF_STAGGER):
+            self.dataInfo['staggerName'] = SDF_STAGGER[self.blockInfo['stagger']]
+        else:
+            self.dataInfo['staggerName'] = ''
+        self.dataInfo['materialID'] = self.blockInfo['materialID']
+        self.dataInfo['materialName'] = self.blockInfo['materialName']
+        self.dataInfo['speciesNames'] = self.blockInfo['speciesNames']
 
 class SDF_BLOCK_species(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-class SDF_BLOCK_plain_derived(sdf_block_data):
+class sdf_derived_data(sdf_block_data):
+    # Super class of derived data (see SDF_DERIVED), which have no data area in the file.
+    # The info area of a derived block holds its registered block ID and species, separated by '\x00'.
+    # Data are computed from the input blocks on demand, chunk by chunk.
+    # The whole data are kept in the data cache (see enableDataCache) when it's enabled,
+    # keyed by the data areas of the inputs, and computed again otherwise.
+
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('units', 'derivedFrom')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-class SDF_BLOCK_point_derived(sdf_block_data):
+        derivedID, species = blockInfo.split('\x00')
+        self.blockInfo['derivedID'] = derivedID
+        self.blockInfo['species'] = species
+        self.blockInfo['inputs'] = tuple([i.replace('{species}', species) for i in SDF_DERIVED[derivedID]['inputs']])
+
+        self.dataInfo['units'] = SDF_DERIVED[derivedID]['units']
+        self.dataInfo['derivedFrom'] = self.blockInfo['inputs']
+
+    def derived(self):
+        return SDF_DERIVED[self.blockInfo['derivedID']]
+
+    def inputs(self):
+        return [self.block.sdf.findData(blockID) for blockID in self.blockInfo['inputs']]
+
+    def cacheKey(self, inputs):
+        # The derived data change whenever the file or the data areas of the inputs do.
+        return ('derived', self.dataInfo['FileName'], self.dataInfo['blockID'],
+                tuple([(dataObj.dataInfo['dataLocation'], dataObj.dataInfo['dataLen']) for dataObj in inputs]),
+                os.stat(self.dataInfo['FileName']).st_mtime)
+
+    def retrieveData(self, mmap = None):
+        cache = dataCache
+        if cache is not None:
+            cacheKey = self.cacheKey(self.inputs())
+            value = cache.get(cacheKey)
+            if value is not None:
+                return value
+        value = self.compute()
+        value.flags.writeable = False
+        if cache is not None:
+            cache.put(cacheKey, value)
+        return value
+
+    # Compute the whole data. Can be rewrite by subclasses.
+    def compute(self):
+        value = np.empty(len(self))
+        chunkLen = max(1, chunkBytes / (8 * (len(self.blockInfo['inputs']) + 1)))
+        for start in xrange(0, len(value), chunkLen):
+            count = min(chunkLen, len(value) - start)
+            value[start:(start + count)] = self.retrieveRange(start, count)
+        return value
+
+    def retrieveRange(self, start, count, dataF = None):
+        chunks = [dataObj.retrieveRange(start, count, dataF) for dataObj in self.inputs()]
+        if len(set([len(chunk) for chunk in chunks])) > 1:
+            raise ValueError('inputs %s of %s differ in size' % (', '.join(self.blockInfo['inputs']),
+                    self.dataInfo['blockID']))
+        return np.asarray(self.derived()['func'](*chunks), dtype = np.float64)
+
+    def retrieveInto(self, data, workers = None, chunk_bytes = None):
+        data.reshape(-1)[...] = self.retrieveData()
+        return data
+
+class SDF_BLOCK_plain_derived(sdf_derived_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_derived_data.dataInfoShowKeys + ('meshID', 'dims',
+            'data_order_c', 'data_shape_c', 'data_shape_c_reduced')
+
     def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+        sdf_derived_data.__init__(self, parentObj, blockInfo)
+
+        if self.derived()['deposit']:
+            grid = self.block.sdf.findData('grid')
+            self.dataInfo['meshID'] = 'grid'
+            self.dataInfo['dims'] = tuple([dim - 1 for dim in grid.dataInfo['dims']])
+        elif self.derived()['regrid'] is not None:
+            firstInput = self.block.sdf.findData(self.blockInfo['inputs'][0])
+            axisRegrid, outShape, outType = firstInput.regridPlan(self.derived()['regrid'])
+            self.dataInfo['meshID'] = firstInput.dataInfo['meshID']
+            self.dataInfo['dims'] = tuple(outShape[::-1])
+        else:
+            firstInput = self.block.sdf.findData(self.blockInfo['inputs'][0])
+            self.dataInfo['meshID'] = firstInput.dataInfo['meshID']
+            self.dataInfo['dims'] = firstInput.dataInfo['dims']
+
+        self.dataInfo['data_order'] = ['F', '[x, y, z]']
+        self.dataInfo['data_shape'] = self.dataInfo['dims']
+        self.dataInfo['data_shape_reduced'] = self.reduce_shape(self.dataInfo['data_shape'])
+        self.dataInfo['data_order_c'] = ['C', '[z, y, x]']
+        self.dataInfo['data_shape_c'] = self.dataInfo['data_shape'][::-1]
+        self.dataInfo['data_shape_c_reduced'] = self.dataInfo['data_shape_reduced'][::-1]
+
+    def cacheKey(self, inputs):
+        if self.derived()['deposit']:
+            inputs = inputs + [self.block.sdf.findData('grid'),
+                    self.block.sdf.findData('grid/' + self.blockInfo['species'])]
+        return sdf_derived_data.cacheKey(self, inputs)
+
+    def computedWhole(self):
+        # Deposits and regridded quantities can't be computed in pieces of the data area.
+        return self.derived()['deposit'] or self.derived()['regrid'] is not None
+
+    def compute(self):
+        if self.derived()['deposit']:
+            return self.deposit()
+        if self.derived()['regrid'] is not None:
+            return self.regridInputs()
+        return sdf_derived_data.compute(self)
+
+    def retrieveRange(self, start, count, dataF = None):
+        # The whole data are computed, or taken from the data cache, if they can't be computed in pieces.
+        if self.computedWhole():
+            return self.retrieveData()[start:(start + count)]
+        return sdf_derived_data.retrieveRange(self, start, count, dataF)
+
+    def rangeReader(self, dataF = None):
+        # A pass over data that can't be computed in pieces computes them once, on its first range,
+        # and keeps them until it's done.
+        if not self.computedWhole():
+            return sdf_derived_data.rangeReader(self, dataF)
+        value = []
+
+        def readRange(start, count):
+            if value == []:
+                value.append(self.retrieveData())
+            return value[0][start:(start + count)]
+        return readRange
+
+    def regridInputs(self):
+        # Combine the inputs regridded slab by slab (see SDF_BLOCK_plain_variable.iter_regrid).
+        to = self.derived()['regrid']
+        func = self.derived()['func']
+        inputs = self.inputs()
+        axisRegrid, outShape, outType = inputs[0].regridPlan(to)
+        rows = max(1, chunkBytes / (8 * (len(inputs) + 1) * max(1, int(np.prod(outShape[1:])))))
+        value = np.empty(outShape)
+        for slabs in itertools.izip(*[dataObj.iter_regrid(to, rows) for dataObj in inputs]):
+            start = slabs[0][0]
+            value[start:(start + len(slabs[0][1]))] = func(*[slab for slabStart, slab in slabs])
+        return value.reshape(-1)
+
+    def deposit(self):
+        # Deposit the particle weights onto the grid cells, chunk by chunk of particles.
+        species = self.blockInfo['species']
+        edges = self.block.sdf.findData('grid').get()
+        ndims = len(edges)
+        inputs = self.inputs()
+        func = self.derived()['func']
+        density = np.zeros([len(edge) - 1 for edge in edges])
+        mesh = self.block.sdf.findData('grid/' + species)
+        chunkLen = max(1, chunkBytes / (8 * (mesh.dataInfo['dataNumOfDimensions'] + len(inputs))))
+        for coords, values in mesh.iter_chunks(chunkLen, inputs):
+            weights = np.asarray(func(*values), dtype = np.float64)
+            density += np.histogramdd(coords[:ndims].T, bins = edges, weights = weights)[0]
+        cellVolume = np.diff(edges[0])
+        for edge in edges[1:]:
+            cellVolume = np.multiply.outer(cellVolume, np.diff(edge))
+        density /= cellVolume
+        # The density is in [x, y, z] order, data are kept in [z, y, x] order as in the files.
+        return np.ascontiguousarray(density.T).reshape(-1)
+
+    def get(self, shapeReduction = True):
+        return self.retrieveData().reshape(self.dataShape(shapeReduction))
+
+    def dataShape(self, shapeReduction = True):
+        if shapeReduction:
+            return self.dataInfo['data_shape_c_reduced']
+        return self.dataInfo['data_shape_c']
+
+    def getp(self):
+        return self.get(True)
+
+    def __getitem__(self, index):
+        return self.get()[index]
+
+class SDF_BLOCK_point_derived(sdf_derived_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_derived_data.dataInfoShowKeys + ('meshID', 'numberOfPoints', 'speciesID')
 
-class SDF_BLOCK_contiguous_tensor(sdf_block_data):
     def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+        sdf_derived_data.__init__(self, parentObj, blockInfo)
+
+        firstInput = self.block.sdf.findData(self.blockInfo['inputs'][0])
+        self.dataInfo['meshID'] = firstInput.dataInfo['meshID']
+        self.dataInfo['numberOfPoints'] = firstInput.dataInfo['numberOfPoints']
+        self.dataInfo['speciesID'] = firstInput.dataInfo['speciesID']
+
+    def iter_chunks(self, n):
+        # Yield the values n points at a time.
+        return self.iterData(n * 8)
+
+class SDF_BLOCK_contiguous_tensor(SDF_BLOCK_stitched_tensor):
+    __slots__ = ()
+
+    contiguous = True
 
 class SDF_BLOCK_contiguous_material(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_contiguous_matvar(sdf_block_data):
-    def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+    __slots__ = ()
 
-class SDF_BLOCK_contiguous_species(sdf_block_data):
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
+class SDF_BLOCK_contiguous_species(SDF_BLOCK_stitched_species):
+    __slots__ = ()
+
+    contiguous = True
+
 class SDF_BLOCK_cpu_split(sdf_block_data):
+    __slots__ = ()
+
+    dataInfoShowKeys = sdf_block_data.dataInfoShowKeys + ('dims', 'data_cpu_split_dim_order')
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-        self.blockInfo['geometry'] = (struct.unpack('i', blockInfo[0:4]))[0]
         dim = len(blockInfo) / 4 - 1
-        self.blockInfo['dims'] = struct.unpack('i' * dim, blockInfo[4:])
+        info = sdfStruct('%di' % (dim + 1)).unpack_from(blockInfo)
+        self.blockInfo['geometry'] = info[0]
+        self.blockInfo['dims'] = info[1:]
 
         if self.blockInfo['geometry'] > 3:
             warningStr = ''
@@ -660,80 +1771,114 @@ class SDF_BLOCK_cpu_split(sdf_block_data):
 
         self.dataInfo['data_cpu_split_dim_order'] = '[x, y, z]'
 
-        self.dataInfoShowKeys += ['dims', 'data_cpu_split_dim_order']
-
     def get(self):
+        # Returns, for each dimension in [x, y, z] order, the cell indices at which the ranks end,
+        # ie. rank i along a dimension holds cells [bounds[i - 1], bounds[i]), with bounds[-1] = 0.
+        # The last rank ends at the number of cells of the grid.
         data = self.retrieveData()
-        dataInDim = []
-        dataVmaxInDim = []
-        for blockObj in self.block.sdf.blocks:
-            blockObjID = blockObj.blockHeader['blockID'].lower()
-            while blockObjID[-1] == '\x00':
-                blockObjID = blockObjID[:-1]
-            if blockObjID == 'grid':
-                for vmax in blockObj.blockInfo['dims']:
-                    dataVmaxInDim.append(vmax - 1)
-                break
-        for dim in self.dataInfo['dims']:
-            dataInDim.append(np.concatenate((data[:dim], [dataVmaxInDim[0]])))
-            dataVmaxInDim = dataVmaxInDim[1:]
-            data = data[dim:]
-        return dataInDim
+        grid = self.block.sdf.findData('grid')
+        cells = [dim - 1 for dim in grid.blockInfo['dims']]
+        splits = np.cumsum(self.dataInfo['dims'])[:-1]
+        return [np.concatenate((oneDim, [n])) for oneDim, n in zip(np.split(data, splits), cells)]
+
+    def rankIndices(self, bounds = None):
+        # Returns, for each dimension in [x, y, z] order, the rank index along it of each cell.
+        if bounds is None:
+            bounds = self.get()
+        return [np.repeat(np.arange(len(b)), np.diff(np.concatenate(([0], b)))) for b in bounds]
+
+    def domains(self):
+        # Returns (lo, hi), the cell index bounds of the domain of each rank:
+        # rank r holds cells lo[r, d] <= i < hi[r, d] along each dimension d, in [x, y, z] order.
+        # Ranks are numbered with x fastest, eg. (hi - lo).prod(1) is the number of cells of each rank.
+        bounds = self.get()
+        ndims = len(bounds)
+        starts = [np.concatenate(([0], b[:-1])) for b in bounds]
+        # meshgrid over [z, y, x], so that x varies fastest when raveled.
+        loGrid = np.meshgrid(*starts[::-1], indexing = 'ij')
+        hiGrid = np.meshgrid(*bounds[::-1], indexing = 'ij')
+        lo = np.stack([loGrid[ndims - 1 - d].ravel() for d in range(ndims)], axis = 1)
+        hi = np.stack([hiGrid[ndims - 1 - d].ravel() for d in range(ndims)], axis = 1)
+        return lo, hi
+
+    def rankMap(self):
+        # Returns the rank holding each cell, as an array in C order, ie. [z, y, x].
+        # Ranks are numbered as in self.domains.
+        bounds = self.get()
+        ndims = len(bounds)
+        rankMap = np.zeros([b[-1] for b in bounds[::-1]], dtype = np.int64)
+        stride = 1
+        for d, oneDim in enumerate(self.rankIndices(bounds)):
+            shape = [1] * ndims
+            shape[ndims - 1 - d] = len(oneDim)
+            rankMap += oneDim.reshape(shape) * stride
+            stride *= len(bounds[d])
+        return rankMap
 
     def getp(self):
-        dataInDim = self.get()
-        stride = 4
-        Max = 7
-        dataP = 0
-        unit = 0
-        for oneDim in dataInDim:
-            unitList = []
-            preStep = 0
-            for step in oneDim:
-                unitList += [unit] * (step - preStep)
-                preStep = step
-                unit = (unit + stride) % Max
-            dataP = np.array(unitList)
-            unit = np.array(unitList)
-        return dataP
+        # Colours the domains of the ranks in C order, so that neighbouring ranks differ.
+        bounds = self.get()
+        ndims = len(bounds)
+        colourMap = np.zeros([b[-1] for b in bounds[::-1]], dtype = np.int64)
+        for d, oneDim in enumerate(self.rankIndices(bounds)):
+            shape = [1] * ndims
+            shape[ndims - 1 - d] = len(oneDim)
+            colourMap += oneDim.reshape(shape)
+        return (4 * colourMap) % 7
 
 class SDF_BLOCK_stitched_obstacle_group(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_unstructured_mesh(sdf_block_data):
-    def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+    __slots__ = ()
 
-class SDF_BLOCK_stitched(sdf_block_data):
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
-class SDF_BLOCK_contiguous(sdf_block_data):
-    def __init__(self, parentObj, blockInfo):
-        sdf_block_data.__init__(self, parentObj, blockInfo)
+# Generic stitched and contiguous blocks have the info area of the tensor ones:
+# stagger, mesh ID, then the variable IDs.
+class SDF_BLOCK_stitched(SDF_BLOCK_stitched_tensor):
+    __slots__ = ()
+
+class SDF_BLOCK_contiguous(SDF_BLOCK_contiguous_tensor):
+    __slots__ = ()
 
 class SDF_BLOCK_lagrangian_mesh(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_station(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_station_derived(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_datablock(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_namevalue(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
 class SDF_BLOCK_scrubbed(sdf_block_data):
+    __slots__ = ()
+
     def __init__(self, parentObj, blockInfo):
         sdf_block_data.__init__(self, parentObj, blockInfo)
 
@@ -773,45 +1918,68 @@ SDF_BLOCK = [
 ]
 
 
+class _block_header(collections.namedtuple('_block_header', ['nextBlockLocation', 'dataLocation',
+        'blockID', 'dataLen', 'blockType', 'dataType', 'numberOfDimensions', 'blockName', 'blockInfoLen'])):
+    # Contains block header content, as a compact record.
+    # Fields can be read as attributes, or by name as in a dictionary.
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def has_key(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return zip(self._fields, self)
+
+
 class _block(object):
     # Describes a block of an sdf file.
     # Contains a self.blockData object which abstracts the data area of the block.
 
+    __slots__ = ('sdf', 'blockNo', 'blockLocation', 'blockHeader', 'blockData')
+
     def __init__(self, blockNum, parentObj, dataFileName, blockLocation, blockHeader, blockInfo):
-        self.FileName = dataFileName
         self.blockNo = blockNum
-        self.blockIndex = blockNum - 1
         self.blockLocation = blockLocation
 
         self.sdf = parentObj
 
-        # Contains block header content.
-        self.blockHeader = {}
+        # Contains block header content (see _block_header).
+        header = SDF_BLOCK_HEADER_STRUCT.unpack_from(blockHeader)
+        self.blockHeader = _block_header(header[0], header[1], header[2].strip(), header[3],
+                header[4], header[5], header[6], header[7].strip(),
+                header[8])   # blockInfoLen contains only info, no header
 
         # An data object that contains data information and provides data operation.
         # It's of different class type according to block type.
         self.blockData = None
+        self.blockData = SDF_BLOCK[self.blockHeader.blockType](self, blockInfo)
 
-        # Contains content from info area of a block. Filled by data object.
-        self.blockInfo = None
-
-        # Collection of all useful information about the data area of a block.
-        self.DataInfo = None
+    @property
+    def FileName(self):
+        return self.sdf.FileName
 
-        self.blockHeader['nextBlockLocation'] = (struct.unpack('q', blockHeader[:8]))[0]
-        self.blockHeader['dataLocation'] = (struct.unpack('q', blockHeader[8:16]))[0]
-        self.blockHeader['blockID'] = blockHeader[16:48].strip()
-        self.blockHeader['dataLen'] = (struct.unpack('q', blockHeader[48:56]))[0]
-        self.blockHeader['blockType'] = (struct.unpack('i', blockHeader[56:60]))[0]
-        self.blockHeader['dataType'] = (struct.unpack('i', blockHeader[60:64]))[0]
-        self.blockHeader['numberOfDimensions'] = (struct.unpack('i', blockHeader[64:68]))[0]
-        self.blockHeader['blockName'] = blockHeader[68:132].strip()
-        self.blockHeader['blockInfoLen'] = (struct.unpack('i', blockHeader[132:136]))[0]   # blockInfoLen contains only info, no header
+    @property
+    def blockIndex(self):
+        return self.blockNo - 1
 
-        self.blockData = SDF_BLOCK[self.blockHeader['blockType']](self, blockInfo)
+    # Contains content from info area of a block. Filled by data object.
+    @property
+    def blockInfo(self):
+        return self.blockData.blockInfo
 
-        self.blockInfo = self.blockData.blockInfo
-        self.dataInfo = self.blockData.dataInfo
+    # Collection of all useful information about the data area of a block.
+    @property
+    def dataInfo(self):
+        return self.blockData.dataInfo
 
     def __repr__(self):
         return '<Block [%d] in %s : %s : %s>' % (self.blockIndex, self.FileName, self.blockHeader['blockName'], self.blockHeader['blockID'])
@@ -845,48 +2013,234 @@ class _SDF(object):
         self.FileName = dataFileName
 
         # Contains content of SDF header.
-        self.SDFHeader = {}
+        # Filled in when the file is first touched, see self.load.
+        self._SDFHeader = None
 
         # A list holds the block objects.
-        self.blocks = []
-
-        f = open(dataFileName, 'rb')
-        headerStr = f.read(112)
-
-        self.SDFHeader['SDFMagic'] = headerStr[0:4]
-        self.SDFHeader['constEndianness'] = (struct.unpack('i', headerStr[4:8]))[0]
-        self.SDFHeader['sdfVersion'] = (struct.unpack('i', headerStr[8:12]))[0]
-        self.SDFHeader['sdfRevision'] = (struct.unpack('i', headerStr[12:16]))[0]
-        self.SDFHeader['codeName'] = headerStr[16:48].strip()
-        self.SDFHeader['firstBlockLocation'] = (struct.unpack('q', headerStr[48:56]))[0]
-        self.SDFHeader['summaryLocation'] = (struct.unpack('q', headerStr[56:64]))[0]
-        self.SDFHeader['summarySize'] = (struct.unpack('i', headerStr[64:68]))[0]
-        self.SDFHeader['numberOfBlocks'] = (struct.unpack('i', headerStr[68:72]))[0]
-        self.SDFHeader['blockHeaderLength'] = (struct.unpack('i', headerStr[72:76]))[0]
-        self.SDFHeader['step'] = (struct.unpack('i', headerStr[76:80]))[0]
-        self.SDFHeader['time'] = (struct.unpack('d', headerStr[80:88]))[0]
-        self.SDFHeader['jobID'] = {}
-        self.SDFHeader['jobID']['startSeconds'] = (struct.unpack('i', headerStr[88:92]))[0]
-        self.SDFHeader['jobID']['startMilliSeconds'] = (struct.unpack('i', headerStr[92:96]))[0]
-        self.SDFHeader['stringLen'] = (struct.unpack('i', headerStr[96:100]))[0]
-        self.SDFHeader['codeIOVersion'] = (struct.unpack('i', headerStr[100:104]))[0]
-        self.SDFHeader['restartFlag'] = (struct.unpack('i', headerStr[104:108]))[0]
-        self.SDFHeader['constNonRestartFlag'] = (struct.unpack('i', headerStr[108:112]))[0]
+        # Filled in when the file is first touched, see self.load.
+        self._blocks = None
 
-        numBlocks = 0
-        nextBlockLocation = self.SDFHeader['firstBlockLocation']
-        while numBlocks < self.SDFHeader['numberOfBlocks']:
-            thisBlockLocation = nextBlockLocation
-            f.seek(thisBlockLocation)
-            numBlocks = numBlocks + 1
+        # The number of blocks and the data objects by block ID, see self.findData.
+        self._blockIDs = None
+
+    @property
+    def SDFHeader(self):
+        if self._SDFHeader is None:
+            self.load()
+        return self._SDFHeader
 
-            blockHeader = f.read(self.SDFHeader['blockHeaderLength'])
-            blockInfoLen = (struct.unpack('i', blockHeader[132:136]))[0]
-            blockInfo = f.read(blockInfoLen)
-            self.blocks.append(_block(numBlocks, self, dataFileName, thisBlockLocation, blockHeader, blockInfo))
-            nextBlockLocation = (struct.unpack('q', blockHeader[:8]))[0]
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self.load()
+        return self._blocks
+
+    def isLoaded(self):
+        return self._blocks is not None
+
+    def load(self):
+        # Parse the SDF header and the block list from the file.
+        # Called on demand, so that a file is not opened until it's actually used.
+
+        if self._blocks is not None:
+            return
+        headerStr, blockMeta = self.fetchMeta()
+        self.parse(headerStr, blockMeta)
+        self.d.showWarnings()
+
+    def aload(self, callback = None):
+        # Asynchronous self.load(): returns at once a future of this file, once parsed.
+        def loadFile():
+            self.load()
+            return self
+        return submitAsync(('load', id(self.d), self.FileName), loadFile, callback)
+
+    def fetchMeta(self):
+        # Get the raw header data of the file, from the metadata cache when possible.
+        # Safe to be called from threads other than the main one.
+
+        meta = self.d.cachedMeta(self.FileName)
+        if meta is None:
+            if self.d.metadataCache:
+                fileStat = os.stat(self.FileName)
+            meta = self.readMeta()
+            if self.d.metadataCache:
+                self.d.cacheMeta(self.FileName, fileStat, meta)
+                self.d.SDFStats.setdefault(self.FileName, (fileStat.st_size, fileStat.st_mtime))
+        return meta
+
+    @profiled('headerTime')
+    def readMeta(self):
+        # Read the raw SDF header and the raw header and info area of each block.
+        # Returns the header string, and a list of (blockLocation, blockHeader, blockInfo).
+        # The summary section, which holds the headers and info areas of all blocks,
+        # is read at once when present. Otherwise the block chain is followed.
+
+        f = openSDF(self.FileName, 'header')
+        headerStr = readBytes(f, None, SDF_HEADER_STRUCT.size, 'header')
+        header = SDF_HEADER_STRUCT.unpack(headerStr)
+        firstBlockLocation, summaryLocation, summarySize, numberOfBlocks, blockHeaderLength = header[5:10]
+
+        blockMeta = None
+        if summaryLocation > 0 and summarySize > 0:
+            blockMeta = self.splitSummary(readBytes(f, summaryLocation, summarySize, 'header'), numberOfBlocks,
+                    blockHeaderLength, firstBlockLocation)
+
+        if blockMeta is None:
+            blockMeta = []
+            nextBlockLocation = firstBlockLocation
+            while len(blockMeta) < numberOfBlocks:
+                thisBlockLocation = nextBlockLocation
+                blockHeader = readBytes(f, thisBlockLocation, blockHeaderLength, 'header')
+                header = SDF_BLOCK_HEADER_STRUCT.unpack_from(blockHeader)
+                blockInfo = readBytes(f, None, header[8], 'header')
+                blockMeta.append((thisBlockLocation, blockHeader, blockInfo))
+                nextBlockLocation = header[0]
 
         f.close()
+        return headerStr, blockMeta
+
+    def splitSummary(self, summary, numberOfBlocks, blockHeaderLength, firstBlockLocation):
+        # Split the summary section into the headers and info areas of the blocks,
+        # which are stored one after another.
+        # Returns None if the summary doesn't look right, so that the caller falls back.
+
+        blockMeta = []
+        pos = 0
+        nextBlockLocation = firstBlockLocation
+        while len(blockMeta) < numberOfBlocks:
+            if pos + blockHeaderLength > len(summary):
+                return None
+            header = SDF_BLOCK_HEADER_STRUCT.unpack_from(summary, pos)
+            nextLocation, blockType, blockInfoLen = header[0], header[4], header[8]
+            blockHeader = summary[pos:(pos + blockHeaderLength)]
+            pos += blockHeaderLength
+            if blockType < 0 or blockType >= len(SDF_BLOCK) or blockInfoLen < 0 \
+                    or pos + blockInfoLen > len(summary):
+                return None
+            blockInfo = summary[pos:(pos + blockInfoLen)]
+            pos += blockInfoLen
+            blockMeta.append((nextBlockLocation, blockHeader, blockInfo))
+            nextBlockLocation = nextLocation
+        return blockMeta
+
+    @profiled('headerTime')
+    def parse(self, headerStr, blockMeta):
+        # Build self.SDFHeader and self.blocks from the raw data given by self.readMeta.
+
+        SDFHeader = {}
+        blocks = []
+
+        header = SDF_HEADER_STRUCT.unpack_from(headerStr)
+        SDFHeader['SDFMagic'] = header[0]
+        SDFHeader['constEndianness'] = header[1]
+        SDFHeader['sdfVersion'] = header[2]
+        SDFHeader['sdfRevision'] = header[3]
+        SDFHeader['codeName'] = header[4].strip()
+        SDFHeader['firstBlockLocation'] = header[5]
+        SDFHeader['summaryLocation'] = header[6]
+        SDFHeader['summarySize'] = header[7]
+        SDFHeader['numberOfBlocks'] = header[8]
+        SDFHeader['blockHeaderLength'] = header[9]
+        SDFHeader['step'] = header[10]
+        SDFHeader['time'] = header[11]
+        SDFHeader['jobID'] = {}
+        SDFHeader['jobID']['startSeconds'] = header[12]
+        SDFHeader['jobID']['startMilliSeconds'] = header[13]
+        SDFHeader['stringLen'] = header[14]
+        SDFHeader['codeIOVersion'] = header[15]
+        SDFHeader['restartFlag'] = header[16]
+        SDFHeader['constNonRestartFlag'] = header[17]
+
+        # Blocks refer to the header while being constructed.
+        self._SDFHeader = SDFHeader
+
+        numBlocks = 0
+        for blockLocation, blockHeader, blockInfo in blockMeta:
+            numBlocks = numBlocks + 1
+            blocks.append(_block(numBlocks, self, self.FileName, blockLocation, blockHeader, blockInfo))
+
+        # Derived blocks look up their inputs among the blocks.
+        self._blocks = blocks
+        self.addDerivedBlocks()
+
+    def addDerivedBlocks(self):
+        # Append a virtual block for each derived quantity (see SDF_DERIVED) available in this file.
+        blockIDs = {}
+        species = []
+        for blockObj in self._blocks:
+            blockID = stripNull(blockObj.blockHeader.blockID)
+            blockIDs[blockID] = blockObj
+            if blockObj.blockHeader.blockType == SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_POINT_MESH') and '/' in blockID:
+                species.append(blockID.split('/', 1)[1])
+        species.sort()
+
+        for derivedID, derived in SDF_DERIVED.items():
+            speciesList = ['']
+            if '{species}' in derivedID:
+                speciesList = species
+            for oneSpecies in speciesList:
+                inputs = [i.replace('{species}', oneSpecies) for i in derived['inputs']]
+                if derived['deposit']:
+                    inputs += ['grid', 'grid/' + oneSpecies]
+                if not all([i in blockIDs for i in inputs]):
+                    continue
+                # The inputs are combined element by element, so they must have the same size,
+                # eg. the number of cells, or of particles of the mesh deposited on the grid,
+                # or the same shape once regridded.
+                sizedInputs = inputs
+                if derived['deposit']:
+                    sizedInputs = inputs[:-2] + inputs[-1:]
+                inputSizes = set()
+                for i in sizedInputs:
+                    dataObj = blockIDs[i].blockData
+                    if derived['regrid'] is not None:
+                        try:
+                            inputSizes.add(tuple(dataObj.regridPlan(derived['regrid'])[1]))
+                        except (AttributeError, KeyError, ValueError):
+                            inputSizes.add(None)
+                    else:
+                        inputSizes.add((dataObj.dataInfo.get('dims'), dataObj.dataInfo.get('numberOfPoints')))
+                if len(inputSizes) > 1 or None in inputSizes:
+                    warningS = self.FileName + ', ' + derivedID.replace('{species}', oneSpecies) + \
+                            ' not derived, inputs ' + ', '.join(sizedInputs) + ' cannot be combined'
+                    self.d.warningStrings.append(warningS)
+                    continue
+                firstHeader = blockIDs[inputs[0]].blockHeader
+                if derived['deposit']:
+                    grid = blockIDs['grid'].blockData
+                    blockType = SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_PLAIN_DERIVED')
+                    ndims = grid.dataInfo['dataNumOfDimensions']
+                    count = int(np.prod([dim - 1 for dim in grid.dataInfo['dims']]))
+                elif firstHeader.blockType == SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_PLAIN_VARIABLE'):
+                    blockType = SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_PLAIN_DERIVED')
+                    ndims = firstHeader.numberOfDimensions
+                    count = len(blockIDs[inputs[0]].blockData)
+                    if derived['regrid'] is not None:
+                        count = int(np.prod(list(inputSizes)[0]))
+                elif firstHeader.blockType == SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_POINT_VARIABLE'):
+                    blockType = SDF_BLOCKTYPE.index('SDF_BLOCKTYPE_POINT_DERIVED')
+                    ndims = 1
+                    count = len(blockIDs[inputs[0]].blockData)
+                else:
+                    continue
+                blockID = derivedID.replace('{species}', oneSpecies)
+                blockName = derived['blockName'].replace('{species}', oneSpecies)
+                blockInfo = derivedID + '\x00' + oneSpecies
+                blockHeader = SDF_BLOCK_HEADER_STRUCT.pack(0, 0, blockID.ljust(idLen), count * 8, blockType,
+                        SDF_DATATYPE.index('SDF_DATATYPE_REAL8'), ndims, blockName.ljust(stringLen), len(blockInfo))
+                self._blocks.append(_block(len(self._blocks) + 1, self, self.FileName, 0, blockHeader, blockInfo))
+
+    def findData(self, blockID):
+        # Returns the data object of the block of the given ID, or None.
+        # The data objects are indexed by ID on first use, and again when blocks are added.
+        blocks = self.blocks
+        if self._blockIDs is None or self._blockIDs[0] != len(blocks):
+            blockIDs = {}
+            for blockObj in blocks:
+                blockIDs.setdefault(stripNull(blockObj.blockHeader.blockID), blockObj.blockData)
+            self._blockIDs = (len(blocks), blockIDs)
+        return self._blockIDs[1].get(blockID)
 
     def __repr__(self):
         return '<SDF File : %s>' % (self.FileName)
@@ -927,11 +2281,46 @@ class _d(object):
     # Maintains all SDF files. Origin for all other objects and operations.
     # Created only once and only one instance.
     # Contains a dictionary of SDF object(_SDF).
+    # SDF objects are created without opening the files,
+    # which are parsed when first touched by self.sf, self.sd or indexing.
 
-    def __init__(self, wd):
+    def __init__(self, wd, mmap = False, metadata_cache = False, workers = None,
+            read_workers = None, read_chunk_bytes = None):
         self.warningStrings = []
         self.errorStrings = []
 
+        # Number of warningStrings already printed, see self.showWarnings.
+        self.warningsShown = 0
+        self.warningsLock = threading.Lock()
+
+        # If True, data are memory mapped rather than read into memory,
+        # and get() returns read-only views over the sdf files.
+        self.mmap = mmap
+
+        # With more than one read worker, a data area larger than readChunkBytes
+        # is read in ranges of readChunkBytes bytes by a pool of threads.
+        self.readWorkers = read_workers
+        self.readChunkBytes = read_chunk_bytes
+        if self.readChunkBytes is None:
+            self.readChunkBytes = chunkBytes
+
+        # If True, the raw headers of the sdf files in a directory are kept
+        # in a cache file there (see metadataCacheName), and files are only
+        # read again when their size or modification time changes.
+        self.metadataCache = metadata_cache
+
+        # A dictionary holds the cached raw headers.
+        # The keys are the file names, the values are (size, mtime, (headerStr, blockMeta)).
+        self.metaCache = {}
+        self.metaCacheChanged = False
+        self.metaCacheLock = threading.Lock()
+        if self.metadataCache:
+            # Files loaded one by one, eg. by indexing, are saved at exit at the latest.
+            atexit.register(_flushMetadataCacheAtExit, weakref.ref(self))
+
+        # A collection of all the data in the files, created by self.sd.
+        self.allData = None
+
         # A list holds the sdf file names.
         self.SDFFileNames = []
 
@@ -939,6 +2328,12 @@ class _d(object):
         # The keys are the file names.
         self.SDFSet = {}
 
+        # A dictionary holds the (size, mtime) of the sdf files when they were added,
+        # by which self.refresh tells the changed files.
+        # The files listed here aren't stat'ed, unless the metadata cache does it anyway:
+        # their stats are recorded by the first refresh, against self.listTime.
+        self.SDFStats = {}
+
         # A list holds the directories,
         # in which sdf files are searched when the class is initialized.
         self.SDFDirs = []
@@ -970,6 +2365,7 @@ class _d(object):
             self.warningStrings.append(warningS)
 
         self.SDFDirs.sort()
+        self.listTime = time.time()
         for SDFDir in self.SDFDirs:
             fileSet = os.listdir(SDFDir)
             fileSet.sort()
@@ -978,6 +2374,13 @@ class _d(object):
                     absFileName = os.path.abspath(SDFDir + pathSeparator() + fileName)
                     self.SDFFileNames.append(absFileName)
                     self.SDFSet[absFileName] = _SDF(absFileName, self)
+            if self.metadataCache:
+                self.loadMetadataCache(SDFDir)
+
+        # With several workers, all the files are scanned at once,
+        # rather than each being parsed when first touched.
+        if workers is not None and workers > 1:
+            self.scan(workers)
 
     def __repr__(self):
         return '<Set of SDF Files>'
@@ -1011,6 +2414,157 @@ class _d(object):
             return True
         return False
 
+    def isComplete(self, fileName):
+        # Whether an sdf file has been completely written, ie. its header is final
+        # and the summary section, or else every block, lies within the file.
+        # EPOCH rewrites the header and writes the summary last, when it closes the file.
+        try:
+            f = openSDF(fileName, 'header')
+        except IOError:
+            return False
+        try:
+            fileSize = os.fstat(f.fileno()).st_size
+            headerStr = readBytes(f, None, SDF_HEADER_STRUCT.size, 'header')
+            if len(headerStr) < SDF_HEADER_STRUCT.size:
+                return False
+            header = SDF_HEADER_STRUCT.unpack(headerStr)
+            if header[0] != 'SDF1':
+                return False
+            firstBlockLocation, summaryLocation, summarySize, numberOfBlocks, blockHeaderLength = header[5:10]
+            if numberOfBlocks <= 0:
+                return False
+            if summaryLocation > 0 and summarySize > 0:
+                return summaryLocation + summarySize <= fileSize
+            nextBlockLocation = firstBlockLocation
+            for i in xrange(numberOfBlocks):
+                if nextBlockLocation + blockHeaderLength > fileSize:
+                    return False
+                blockHeader = SDF_BLOCK_HEADER_STRUCT.unpack(
+                        readBytes(f, nextBlockLocation, SDF_BLOCK_HEADER_STRUCT.size, 'header'))
+                nextBlockLocation, dataLocation, dataLen = blockHeader[0], blockHeader[1], blockHeader[3]
+                if dataLocation + dataLen > fileSize:
+                    return False
+            return True
+        finally:
+            f.close()
+
+    def refresh(self, min_age = 0):
+        # Pick up the sdf files added to or changed in self.SDFDirs since they were listed,
+        # without touching the files already known, and drop the files removed.
+        # Files not yet completely written (see self.isComplete), or modified less than
+        # min_age seconds ago, are left for a later refresh.
+        # Returns a list of the sdf files (_SDF) added or replaced, in the order of file names.
+
+        now = time.time()
+        fileNames = []
+        newFiles = []
+        for SDFDir in self.SDFDirs:
+            try:
+                fileSet = os.listdir(SDFDir)
+            except OSError:
+                continue
+            fileSet.sort()
+            for fileName in fileSet:
+                if not self.isSDF(fileName):
+                    continue
+                absFileName = os.path.abspath(SDFDir + pathSeparator() + fileName)
+                try:
+                    fileStat = os.stat(absFileName)
+                except OSError:
+                    continue
+                stat = (fileStat.st_size, fileStat.st_mtime)
+                if absFileName in self.SDFSet and not absFileName in self.SDFStats:
+                    # Listed when the class was initialized: unchanged since unless modified afterwards.
+                    if fileStat.st_mtime < self.listTime:
+                        self.SDFStats[absFileName] = stat
+                    else:
+                        self.SDFStats[absFileName] = None
+                if self.SDFStats.get(absFileName) != stat:
+                    if now - fileStat.st_mtime < min_age or not self.isComplete(absFileName):
+                        if absFileName in self.SDFSet:
+                            fileNames.append(absFileName)
+                        continue
+                    if absFileName in self.metaCache:
+                        del self.metaCache[absFileName]
+                        self.metaCacheChanged = True
+                    self.SDFSet[absFileName] = _SDF(absFileName, self)
+                    self.SDFStats[absFileName] = stat
+                    newFiles.append(self.SDFSet[absFileName])
+                fileNames.append(absFileName)
+
+        fileNameSet = set(fileNames)
+        for fileName in self.SDFFileNames:
+            if not fileName in fileNameSet:
+                del self.SDFSet[fileName]
+                self.SDFStats.pop(fileName, None)
+        if newFiles != [] or len(fileNames) != len(self.SDFFileNames):
+            self.SDFFileNames = fileNames
+            self.allData = None
+        return newFiles
+
+    def watch(self, callback = None, interval = 1.0, timeout = None, min_age = 1.0):
+        # Follow a running simulation: keep refreshing (see self.refresh) and hand over
+        # each sdf file as soon as it has been completely written.
+        # If callback is given, it is called with each new file (_SDF), until timeout seconds
+        # have passed (never if timeout is None). Otherwise a generator of the new files is returned.
+        # The directories are watched by inotify when pyinotify is installed,
+        # and polled every interval seconds otherwise.
+        newFiles = self.watchFiles(interval, timeout, min_age)
+        if callback is None:
+            return newFiles
+        for sdfFile in newFiles:
+            callback(sdfFile)
+
+    def watchFiles(self, interval, timeout, min_age):
+        # The generator of self.watch.
+        try:
+            import pyinotify
+        except ImportError:
+            pyinotify = None
+
+        notifier = None
+        if pyinotify is not None:
+            watchManager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE | pyinotify.IN_MODIFY
+            for SDFDir in self.SDFDirs:
+                watchManager.add_watch(SDFDir, mask)
+            notifier = pyinotify.Notifier(watchManager, default_proc_fun = lambda event: None)
+
+        endTime = None
+        if timeout is not None:
+            endTime = time.time() + timeout
+        try:
+            while True:
+                for sdfFile in self.refresh(min_age):
+                    yield sdfFile
+                wait = interval
+                if endTime is not None:
+                    wait = min(wait, endTime - time.time())
+                    if wait <= 0:
+                        return
+                if notifier is not None:
+                    # Wake up early when the directories change.
+                    if notifier.check_events(timeout = int(wait * 1000)):
+                        notifier.read_events()
+                        notifier.process_events()
+                else:
+                    time.sleep(wait)
+        finally:
+            if notifier is not None:
+                notifier.stop()
+
+    def profileIO(self):
+        # A context manager counting the I/O on sdf files, see profileIO.
+        return profileIO()
+
+    def ioStatsInfo(self, by = 'file'):
+        # Returns the I/O statistics of the files in this collection,
+        # summed by 'file', 'blockType' or 'total', or None if not profiling (see profileIO).
+        if ioStats is None:
+            print 'Warning: I/O statistics are not being kept, see profileIO.'
+            return None
+        return ioStats.summary(by, self.SDFFileNames)
+
     def sf(self, *args, **kwargs):
         fileList = []
         for fileName in self.SDFFileNames:
@@ -1018,11 +2572,115 @@ class _d(object):
         return _searched_files(fileList).sf(*args, **kwargs)
 
     def sd(self, *args, **kwargs):
-        dataList = []
+        # The collection of all data, with its search indices, is kept for later searches.
+        if self.allData is None:
+            dataList = []
+            for fileName in self.SDFFileNames:
+                for block in self.SDFSet[fileName].blocks:
+                    dataList.append(block.blockData)
+            self.allData = _searched_data(dataList)
+        self.flushMetadataCache()
+        return self.allData.sd(*args, **kwargs)
+
+    def scan(self, workers):
+        # Read the headers of the files not yet loaded with a pool of threads,
+        # which hides the latency of the file system,
+        # then parse them in the order of file names.
+        fileList = []
         for fileName in self.SDFFileNames:
-            for block in self.SDFSet[fileName].blocks:
-                dataList.append(block.blockData)
-        return _searched_data(dataList).sd(*args, **kwargs)
+            if not self.SDFSet[fileName].isLoaded():
+                fileList.append(self.SDFSet[fileName])
+        scanResults = threadMap(self.scanFile, fileList, workers)
+        for sdfFile, (meta, errorS) in zip(fileList, scanResults):
+            if meta is None:
+                warningS = sdfFile.FileName + " cannot be scanned: " + errorS
+                self.warningStrings.append(warningS)
+            else:
+                sdfFile.parse(*meta)
+        self.flushMetadataCache()
+
+    def showWarnings(self):
+        # Print the warnings added since the last call,
+        # eg. those raised while a file is parsed on demand.
+        with self.warningsLock:
+            warningStrings = self.warningStrings[self.warningsShown:]
+            self.warningsShown += len(warningStrings)
+        for warningS in warningStrings:
+            print 'Warning:', warningS
+
+    def scanFile(self, sdfFile):
+        # Runs in a worker thread of self.scan. Returns (meta, errorString).
+        try:
+            return sdfFile.fetchMeta(), None
+        except (IOError, OSError, struct.error) as e:
+            return None, str(e)
+
+    def cachedMeta(self, fileName):
+        # Returns the cached (headerStr, blockMeta) of a file, or None.
+        if fileName in self.metaCache:
+            return self.metaCache[fileName][2]
+        return None
+
+    def cacheMeta(self, fileName, fileStat, meta):
+        self.metaCache[fileName] = (fileStat.st_size, fileStat.st_mtime, meta)
+        self.metaCacheChanged = True
+
+    def loadMetadataCache(self, SDFDir):
+        # Take the cache entries of the files that haven't changed since they were cached.
+        cacheFileName = SDFDir + pathSeparator() + metadataCacheName
+        if not os.path.isfile(cacheFileName):
+            return
+        try:
+            cacheF = open(cacheFileName, 'rb')
+            version, entries = marshal.load(cacheF)
+            cacheF.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            warningS = "metadata cache " + cacheFileName + " cannot be read, ignored."
+            self.warningStrings.append(warningS)
+            return
+        if not version == metadataCacheVersion:
+            return
+        for baseName, (size, mtime, meta) in entries.items():
+            absFileName = SDFDir + pathSeparator() + baseName
+            if not absFileName in self.SDFSet:
+                continue
+            fileStat = os.stat(absFileName)
+            self.SDFStats[absFileName] = (fileStat.st_size, fileStat.st_mtime)
+            if fileStat.st_size == size and fileStat.st_mtime == mtime:
+                self.metaCache[absFileName] = (size, mtime, meta)
+
+    def flushMetadataCache(self):
+        # Save the metadata cache if headers were read since it was last saved.
+        with self.metaCacheLock:
+            if self.metaCacheChanged:
+                self.saveMetadataCache()
+
+    def saveMetadataCache(self):
+        # Write the cached headers of the files in each directory to its cache file.
+        # A directory that cannot be written is skipped with a warning.
+        for SDFDir in self.SDFDirs:
+            entries = {}
+            for fileName, entry in self.metaCache.items():
+                if os.path.dirname(fileName) == SDFDir:
+                    entries[os.path.basename(fileName)] = entry
+            if entries == {}:
+                continue
+            cacheFileName = SDFDir + pathSeparator() + metadataCacheName
+            try:
+                cacheF = open(cacheFileName + '.tmp', 'wb')
+                marshal.dump((metadataCacheVersion, entries), cacheF, 2)
+                cacheF.close()
+                os.rename(cacheFileName + '.tmp', cacheFileName)
+            except (IOError, OSError):
+                warningS = "metadata cache " + cacheFileName + " cannot be written, ignored."
+                self.warningStrings.append(warningS)
+        self.metaCacheChanged = False
+
+
+def _flushMetadataCacheAtExit(dataSetRef):
+    dataSet = dataSetRef()
+    if dataSet is not None:
+        dataSet.flushMetadataCache()
 
 
 class _searched_files(object):
@@ -1148,6 +2806,8 @@ class _searched_files(object):
         for fileObj in self.fileList:
             for block in fileObj.blocks:
                 dataList.append(block.blockData)
+        for dataSet in set([fileObj.d for fileObj in self.fileList]):
+            dataSet.flushMetadataCache()
         return _searched_data(dataList).sd(*args, **kwargs)
 
 
@@ -1160,7 +2820,12 @@ class _searched_data(object):
         # Holds the data objects.
         self.dataList = dataList
 
-        self.dataList.sort(cmp = self.cmp_data)
+        self.dataList.sort(key = self.key_data)
+
+        # Indices of the data objects, built on demand by self.indexOf.
+        # The keys are dataInfo keys, the values are dictionaries
+        # from dataInfo values to lists of data objects.
+        self.index = {}
 
     def __add__(self, _sdObject):
         if not type(_sdObject) == type(self):
@@ -1170,11 +2835,13 @@ class _searched_data(object):
             dataList = []
             for dataObj in self.dataList:
                 dataList.append(dataObj)
+            dataSet = set(dataList)
             for dataObj in _sdObject.dataList:
-                if dataObj in dataList:
+                if dataObj in dataSet:
                     pass
                 else:
                     dataList.append(dataObj)
+                    dataSet.add(dataObj)
             return _searched_data(dataList)
 
     def __repr__(self):
@@ -1196,6 +2863,9 @@ class _searched_data(object):
         else:
             return cmp(data1.dataInfo['blockIndex'], data2.dataInfo['blockIndex'])
 
+    def key_data(self, data):
+        return (data.dataInfo['FileName'], data.dataInfo['blockIndex'])
+
     def show(self, full_info = False, full_path = False):
         if not full_info:
             print '%r' % self
@@ -1221,69 +2891,128 @@ class _searched_data(object):
         if kwargs.has_key('rev'):
             rev = True
             kwargs.pop('rev', None)
+        # dataSet mirrors dataList, for fast membership tests.
+        dataSet = set()
+        conditions = []
         for value in args:
             if type(value) == type(1):
-                dataList = dataList + self.selectData(dataList, 'blockIndexInteger', value, rev)
+                conditions.append(('blockIndexInteger', value))
             elif (type(value) == type([])) or (type(value) == type(())):
-                dataList = dataList + self.selectData(dataList, 'dataIndexList', value, rev)
+                conditions.append(('dataIndexList', value))
             elif type(value) == type('a'):
-                dataList = dataList + self.selectData(dataList, 'blockNameOrBlockIDContainStr', value, rev)
+                conditions.append(('blockNameOrBlockIDContainStr', value))
             elif type(value) == type(self):
-                dataList = dataList + self.selectData(dataList, 'importFromAnother', value, rev)
+                conditions.append(('importFromAnother', value))
             else:
                 print 'Warning: data searching condition', value, 'of type', type(value), 'is neglected.'
-        for key, value in kwargs.items():
-            dataList = dataList + self.selectData(dataList, key, value, rev)
+        conditions += kwargs.items()
+        for key, value in conditions:
+            selectedData = self.selectData(dataSet, key, value, rev)
+            dataList += selectedData
+            dataSet.update(selectedData)
         return _searched_data(dataList)
 
+    def indexOf(self, key):
+        # Returns a dictionary from the values of dataInfo[key] to lists of data objects,
+        # together with a list of data objects whose values are not hashable,
+        # and the set of all the data objects having the key.
+        # Returns None if no data object has the key.
+        # Trailing '\x00' of string values are stripped, and both forms are indexed.
+        if not key in self.index:
+            valueIndex = {}
+            unhashable = []
+            keyed = set()
+            for dataObj in self.dataList:
+                if not dataObj.dataInfo.has_key(key):
+                    continue
+                keyed.add(dataObj)
+                compareValue = dataObj.dataInfo[key]
+                try:
+                    valueIndex.setdefault(compareValue, []).append(dataObj)
+                except TypeError:
+                    unhashable.append(dataObj)
+                    continue
+                if type(compareValue) == type(''):
+                    strippedValue = compareValue.rstrip('\x00')
+                    if not strippedValue == compareValue:
+                        valueIndex.setdefault(strippedValue, []).append(dataObj)
+            if keyed:
+                self.index[key] = (valueIndex, unhashable, keyed)
+            else:
+                self.index[key] = None
+        return self.index[key]
+
     def selectData(self, excludeList, key, value, rev):
-        selectedData = []
+        # Returns the data objects meeting the condition key=value (or not, if rev),
+        # that are not in excludeList, in the order of self.dataList.
+        # excludeList is better given as a set.
+        # Only the data objects in candidates, all by default, are tested.
+        matched = set()
+        candidates = None
         if key == 'blockIndexInteger':
-            for dataObj in self.dataList:
-                dataBlockIndex = dataObj.dataInfo['blockIndex']
-                cond = (dataBlockIndex == value)
-                if self.XOR(cond, rev) and (not dataObj in excludeList) and (not dataObj in selectedData):
-                    selectedData.append(dataObj)
+            # No index is built for an empty collection, in which nothing matches.
+            keyIndex = self.indexOf('blockIndex')
+            if keyIndex is not None:
+                valueIndex, unhashable, keyed = keyIndex
+                matched.update(valueIndex.get(value, []))
         elif key == 'dataIndexList':
+            selectedData = []
+            selectedSet = set()
             for index in value:
                 if (type(index) == type(0)) and (index >= 0) and (index < len(self.dataList)):
                     dataObj = self.dataList[index]
-                    if (not dataObj in excludeList) and (not dataObj in selectedData):
+                    if (not dataObj in excludeList) and (not dataObj in selectedSet):
                         selectedData.append(dataObj)
+                        selectedSet.add(dataObj)
+            return selectedData
         elif key == 'blockNameOrBlockIDContainStr':
+            # Blocks sharing the same name and ID are tested only once.
+            if not key in self.index:
+                nameIndex = {}
+                for dataObj in self.dataList:
+                    nameKey = (dataObj.dataInfo['blockName'].upper(), dataObj.dataInfo['blockID'].upper())
+                    nameIndex.setdefault(nameKey, []).append(dataObj)
+                self.index[key] = nameIndex
             value = value.upper()
-            for dataObj in self.dataList:
-                dataBlockName = dataObj.dataInfo['blockName'].upper()
-                dataBlockID = dataObj.dataInfo['blockID'].upper()
-                nameContain = dataBlockName.find(value)
-                IDContain = dataBlockID.find(value)
-                cond = (nameContain != -1) or (IDContain != -1)
-                if self.XOR(cond, rev) and (not dataObj in excludeList) and (not dataObj in selectedData):
-                    selectedData.append(dataObj)
+            for (dataBlockName, dataBlockID), dataObjs in self.index[key].items():
+                if (dataBlockName.find(value) != -1) or (dataBlockID.find(value) != -1):
+                    matched.update(dataObjs)
         elif key == 'importFromAnother':
+            selectedData = []
+            selectedSet = set()
             for dataObj in value:
-                if (not dataObj in excludeList) and (not dataObj in selectedData):
+                if (not dataObj in excludeList) and (not dataObj in selectedSet):
                     selectedData.append(dataObj)
+                    selectedSet.add(dataObj)
+            return selectedData
         else:
-            keyValid = False
-            for dataObj in self.dataList:
-                if dataObj.dataInfo.has_key(key):
-                    keyValid = True
-                    compareValue_x00 = dataObj.dataInfo[key]
-                    compareValue = dataObj.dataInfo[key]
-                    if type(compareValue == ''):
-                        while compareValue[-1] == '\x00':
-                            compareValue = compareValue[:-1]
-                    cond1 = (value == compareValue) or (value == compareValue_x00)
-                    cond2 = False
-                    if (type(value) == type([])) or (type(value) == type(())):
-                        for subValue in value:
-                            cond2 = cond2 or (subValue == compareValue)
-                    cond = cond1 or cond2
-                    if self.XOR(cond, rev) and (not dataObj in excludeList) and (not dataObj in selectedData):
-                        selectedData.append(dataObj)
-            if not keyValid:
+            keyIndex = self.indexOf(key)
+            if keyIndex is None:
                 print 'Warning: data searching condition %s(%r)=%r is neglected.' % (key, not rev, value)
+                return []
+            valueIndex, unhashable, candidates = keyIndex
+            lookupValues = [value]
+            if (type(value) == type([])) or (type(value) == type(())):
+                lookupValues += list(value)
+            for lookupValue in lookupValues:
+                try:
+                    matched.update(valueIndex.get(lookupValue, []))
+                except TypeError:
+                    pass
+            for dataObj in unhashable:
+                compareValue = dataObj.dataInfo[key]
+                cond = (value == compareValue)
+                if (type(value) == type([])) or (type(value) == type(())):
+                    for subValue in value:
+                        cond = cond or (subValue == compareValue)
+                if cond:
+                    matched.add(dataObj)
+        selectedData = []
+        for dataObj in self.dataList:
+            if candidates is not None and not dataObj in candidates:
+                continue
+            if self.XOR(dataObj in matched, rev) and (not dataObj in excludeList):
+                selectedData.append(dataObj)
         return selectedData
 
     def XOR(self, cond, rev):
@@ -1292,18 +3021,630 @@ class _searched_data(object):
         else:
             return cond
 
+    def stack(self, workers = None, shapeReduction = True):
+        # Stack the data of all data objects into one array of shape (len(self), ...),
+        # eg. one variable over all the dumps.
+        # The array is allocated once, and each data area is read straight into it,
+        # by a pool of threads if workers is given.
+        # All the data must be of the same type and shape.
+
+        if self.dataList == []:
+            print 'Warning: no data to stack.'
+            return None
+        firstObj = self.dataList[0]
+        shape = tuple(firstObj.dataShape(shapeReduction))
+        for dataObj in self.dataList:
+            if not (dataObj.dataInfo['dataType'] == firstObj.dataInfo['dataType']
+                    and dataObj.dataInfo['dataLen'] == firstObj.dataInfo['dataLen']
+                    and tuple(dataObj.dataShape(shapeReduction)) == shape):
+                print 'Warning: %r and %r differ in type or shape, cannot be stacked.' % (firstObj, dataObj)
+                return None
+
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[firstObj.dataInfo['dataType']])
+        data = np.empty((len(self.dataList),) + shape, dtype = dataType)
+        dataRows = data.reshape(len(self.dataList), -1)
+
+        def fill(i):
+            self.dataList[i].retrieveInto(dataRows[i])
+
+        if workers is not None and workers > 1:
+            threadMap(fill, range(len(self.dataList)), workers)
+        else:
+            for i in range(len(self.dataList)):
+                fill(i)
+        return data
+
+    def reduce(self, func, chunk_bytes = None, perData = True, bins = 10, bin_range = None):
+        # Reduce the data of each data object, without holding a whole data area in memory.
+        # Data areas are streamed in pieces of chunk_bytes bytes (see sdf_block_data.iterData),
+        # each piece is reduced, and the partial results are combined.
+        # func is either the name of a reduction in SDF_REDUCTIONS or 'hist',
+        # or a tuple (partial, combine, finalize) as in SDF_REDUCTIONS.
+        # Returns an array of the results of each data object,
+        # or the result of all the data if perData is False.
+        # For 'hist', the histograms over the given bins (as in np.histogram) are returned,
+        # together with the bin edges. When bin_range is not given, the data range is used.
+
+        if func == 'hist':
+            if np.ndim(bins) == 0:
+                if bin_range is None:
+                    bin_range = (self.reduce('min', chunk_bytes, perData = False),
+                            self.reduce('max', chunk_bytes, perData = False))
+                binEdges = np.linspace(bin_range[0], bin_range[1], bins + 1)
+            else:
+                binEdges = np.asarray(bins)
+            partial = lambda x: np.histogram(x, bins = binEdges)[0]
+            combine = lambda a, b: a + b
+            finalize = None
+        elif type(func) == type(''):
+            partial, combine, finalize = SDF_REDUCTIONS[func]
+        else:
+            partial, combine, finalize = (tuple(func) + (None,))[:3]
+
+        results = []
+        total = None
+        for dataObj in self.dataList:
+            result = None
+            for chunk in dataObj.iterData(chunk_bytes):
+                if chunk.size == 0:
+                    continue
+                if result is None:
+                    result = partial(chunk)
+                else:
+                    result = combine(result, partial(chunk))
+            if perData:
+                if finalize is not None and result is not None:
+                    result = finalize(result)
+                results.append(result)
+            elif result is not None:
+                if total is None:
+                    total = result
+                else:
+                    total = combine(total, result)
 
-def d(wd = '.'):
-    dataSet = _d(wd)
+        if perData:
+            results = np.array(results)
+        else:
+            results = total
+            if finalize is not None and results is not None:
+                results = finalize(results)
+        if func == 'hist':
+            return results, binEdges
+        return results
+
+    def to_timeseries(self, workers = None, shapeReduction = True):
+        # Returns (data, time, step), where data is given by self.stack,
+        # and time and step are arrays of the time and step of each data.
+
+        data = self.stack(workers = workers, shapeReduction = shapeReduction)
+        if data is None:
+            return None
+        time = np.array([dataObj.dataInfo['time'] for dataObj in self.dataList])
+        step = np.array([dataObj.dataInfo['step'] for dataObj in self.dataList])
+        return data, time, step
+
+    def export(self, path, store_format = 'zarr', chunk_bytes = None, workers = None, compress = True):
+        # Export the data into a chunked, compressed array store in the directory path,
+        # from which parts of the data can be read again without the sdf files.
+        # With store_format 'zarr', a Zarr (version 2) directory store is written, which needs no zarr package:
+        # path/<sdf file name>/<block ID>/ holds one array per data, each chunk a zlib compressed,
+        # C ordered file, and the dataInfo as attributes in .zattrs.
+        # With store_format 'hdf5', path/<sdf file name>.h5 is written by h5py, one dataset per data.
+        # '/' in block IDs is replaced by '.', so that eg. 'grid' and 'grid/electron' don't clash.
+        # Chunks are slabs of the data array of at most chunk_bytes bytes, split along the leading axes.
+        # The sdf files are exported in parallel by a pool of threads, if workers is given.
+        # An interrupted export can be resumed by running it again: data already exported from
+        # an unchanged sdf file, with the same settings, are skipped. Data without a numeric data area are not exported.
+        # Returns the number of data exported.
+
+        if store_format not in ('zarr', 'hdf5'):
+            print 'Warning: unknown export format %r, should be \'zarr\' or \'hdf5\'.' % (store_format,)
+            return None
+        if store_format == 'hdf5':
+            try:
+                importlib.import_module('h5py')
+            except ImportError:
+                print 'Warning: h5py is needed to export to hdf5.'
+                return None
+        if chunk_bytes is None:
+            chunk_bytes = chunkBytes
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if store_format == 'zarr':
+            self.exportJson(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+
+        fileData = collections.OrderedDict()
+        for dataObj in self.dataList:
+            if len(dataObj) > 0 and SDF_TYPE_FOR_NUMPY[dataObj.dataInfo['dataType']] is not None:
+                fileData.setdefault(dataObj.dataInfo['FileName'], []).append(dataObj)
+
+        def exportFile(fileName):
+            try:
+                if store_format == 'zarr':
+                    return self.exportZarr(fileName, fileData[fileName], path, chunk_bytes, compress), None
+                else:
+                    return self.exportHDF5(fileName, fileData[fileName], path, chunk_bytes, compress), None
+            except (IOError, OSError, ValueError) as err:
+                return 0, err
+
+        if workers is not None and workers > 1:
+            results = threadMap(exportFile, fileData.keys(), workers)
+        else:
+            results = [exportFile(fileName) for fileName in fileData]
+
+        exported = 0
+        for fileName, (count, err) in zip(fileData.keys(), results):
+            if err is not None:
+                print 'Warning: failed to export %s: %s' % (fileName, err)
+            exported += count
+        return exported
+
+    def exportJson(self, fileName, obj):
+        # Write obj as json to fileName, by way of a temporary file, so that it's never seen half written.
+        tmpName = fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(obj, f, indent = 1, sort_keys = True)
+        os.rename(tmpName, fileName)
+
+    def exportSource(self, fileName, chunk_bytes, compress):
+        # Identifies the state of an sdf file and the export settings,
+        # to tell whether data exported before can be kept.
+        fileStat = os.stat(fileName)
+        return [fileStat.st_size, fileStat.st_mtime, chunk_bytes, bool(compress)]
+
+    def exportAttrs(self, attrs):
+        # Returns a copy of a dataInfo or SDFHeader, with values that json and hdf5 can hold.
+
+        def convert(value):
+            if isinstance(value, basestring):
+                return stripNull(value)
+            if isinstance(value, np.generic):
+                return value.item()
+            if isinstance(value, (tuple, list, np.ndarray)):
+                return [convert(v) for v in value]
+            if isinstance(value, (bool, int, long, float)) or value is None:
+                return value
+            return repr(value)
+
+        return dict((key, convert(value)) for key, value in attrs.items() if key != 'dataInfoShowKeys')
+
+    def exportChunks(self, dataObj, chunk_bytes):
+        # Returns the shape of the data array and of its chunks, and a generator of the chunks.
+        # The chunks have 1 element along the leading axes, all of them along the trailing axes,
+        # and as many as fit in chunk_bytes along the axis in between,
+        # so each chunk is one contiguous range of the data area.
+        # Yields (chunk index, region in the data array, data of the chunk).
+
+        dataType = np.dtype(SDF_TYPE_FOR_NUMPY[dataObj.dataInfo['dataType']])
+        shape = tuple(dataObj.dataShape())
+        if np.prod(shape) != len(dataObj):
+            shape = (len(dataObj),)
+        chunks = [max(1, n) for n in shape]
+        rowLen = 1
+        for axis in range(len(shape) - 1, -1, -1):
+            if (rowLen * shape[axis]) * dataType.itemsize > chunk_bytes:
+                chunks[axis] = max(1, chunk_bytes / (rowLen * dataType.itemsize))
+                chunks[:axis] = [1] * axis
+                break
+            rowLen *= shape[axis]
+        chunks = tuple(chunks)
+        strides = [int(np.prod(shape[(axis + 1):])) for axis in range(len(shape))]
+        gridShape = [-(-n // c) for n, c in zip(shape, chunks)]
+
+        def generate():
+            dataF = None
+            if not dataObj.block.sdf.d.mmap:
+                dataF = openSDF(dataObj.dataInfo['FileName'], dataObj.dataInfo['blockTypeName'])
+            try:
+                readRange = dataObj.rangeReader(dataF)
+                for chunkIndex in itertools.product(*[xrange(n) for n in gridShape]):
+                    region = tuple(slice(i * c, min((i + 1) * c, n)) for i, c, n in zip(chunkIndex, chunks, shape))
+                    extent = tuple(r.stop - r.start for r in region)
+                    start = sum(r.start * s for r, s in zip(region, strides))
+                    data = readRange(start, int(np.prod(extent)))
+                    yield chunkIndex, region, np.asarray(data, dtype = dataType).reshape(extent)
+            finally:
+                if dataF is not None:
+                    dataF.close()
+
+        return shape, chunks, generate()
+
+    def exportZarr(self, fileName, dataList, path, chunk_bytes, compress):
+        # Export the data of an sdf file to the group path/<sdf file name> of a Zarr store.
+        # An array is complete once its .zarray is written, which is done last.
+        # Chunks written before an interruption are kept if the sdf file and the settings haven't changed since.
+
+        source = self.exportSource(fileName, chunk_bytes, compress)
+        groupDir = os.path.join(path, os.path.splitext(os.path.basename(fileName))[0])
+        if not os.path.isdir(groupDir):
+            os.makedirs(groupDir)
+        self.exportJson(os.path.join(groupDir, '.zgroup'), {'zarr_format': 2})
+        groupAttrs = self.exportAttrs(dataList[0].block.sdf.SDFHeader)
+        groupAttrs['sdfSource'] = source
+        self.exportJson(os.path.join(groupDir, '.zattrs'), groupAttrs)
+
+        exported = 0
+        for dataObj in dataList:
+            arrayDir = os.path.join(groupDir, stripNull(dataObj.dataInfo['blockID']).replace('/', '.'))
+            attrsName = os.path.join(arrayDir, '.zattrs')
+            resume = False
+            if os.path.exists(attrsName):
+                with open(attrsName) as f:
+                    resume = json.load(f).get('sdfSource') == source
+            if resume and os.path.exists(os.path.join(arrayDir, '.zarray')):
+                continue
+            if not os.path.isdir(arrayDir):
+                os.makedirs(arrayDir)
+
+            attrs = self.exportAttrs(dataObj.dataInfo)
+            attrs['sdfSource'] = source
+            self.exportJson(attrsName, attrs)
+            shape, chunks, chunkIter = self.exportChunks(dataObj, chunk_bytes)
+            dataType = np.dtype(SDF_TYPE_FOR_NUMPY[dataObj.dataInfo['dataType']])
+            for chunkIndex, region, data in chunkIter:
+                chunkName = os.path.join(arrayDir, '.'.join([str(i) for i in chunkIndex]))
+                if resume and os.path.exists(chunkName):
+                    continue
+                if data.shape != chunks:
+                    # Zarr keeps the chunks at the edges full sized.
+                    fullData = np.zeros(chunks, dtype = dataType)
+                    fullData[tuple(slice(0, n) for n in data.shape)] = data
+                    data = fullData
+                dataStr = np.ascontiguousarray(data).tostring()
+                if compress:
+                    dataStr = zlib.compress(dataStr, 1)
+                with open(chunkName + '.tmp', 'wb') as f:
+                    f.write(dataStr)
+                os.rename(chunkName + '.tmp', chunkName)
+            self.exportJson(os.path.join(arrayDir, '.zarray'), {
+                'zarr_format': 2,
+                'shape': list(shape),
+                'chunks': list(chunks),
+                'dtype': dataType.str,
+                'compressor': {'id': 'zlib', 'level': 1} if compress else None,
+                'fill_value': 0,
+                'order': 'C',
+                'filters': None,
+            })
+            exported += 1
+        return exported
+
+    def exportHDF5(self, fileName, dataList, path, chunk_bytes, compress):
+        # Export the data of an sdf file to path/<sdf file name>.h5.
+        # The hdf5 file is written under a temporary name and renamed once complete,
+        # so it's skipped on resuming unless the sdf file or the settings have changed since.
+        import h5py
+
+        def hdf5Value(value):
+            if isinstance(value, list):
+                return json.dumps(value)
+            if value is None:
+                return 'None'
+            return value
+
+        source = self.exportSource(fileName, chunk_bytes, compress)
+        h5Name = os.path.join(path, os.path.splitext(os.path.basename(fileName))[0] + '.h5')
+        if os.path.exists(h5Name):
+            with h5py.File(h5Name, 'r') as f:
+                if list(f.attrs.get('sdfSource', [])) == source:
+                    return 0
+
+        with h5py.File(h5Name + '.tmp', 'w') as f:
+            for key, value in self.exportAttrs(dataList[0].block.sdf.SDFHeader).items():
+                f.attrs[key] = hdf5Value(value)
+            for dataObj in dataList:
+                shape, chunks, chunkIter = self.exportChunks(dataObj, chunk_bytes)
+                dataset = f.create_dataset(stripNull(dataObj.dataInfo['blockID']).replace('/', '.'), shape,
+                        dtype = SDF_TYPE_FOR_NUMPY[dataObj.dataInfo['dataType']], chunks = chunks,
+                        compression = 'gzip' if compress else None)
+                for key, value in self.exportAttrs(dataObj.dataInfo).items():
+                    dataset.attrs[key] = hdf5Value(value)
+                for chunkIndex, region, data in chunkIter:
+                    dataset[region] = data
+            f.attrs['sdfSource'] = source
+        os.rename(h5Name + '.tmp', h5Name)
+        return len(dataList)
+
+
+class _data_cache(object):
+    # A process-wide cache of the data read by sdf_block_data.retrieveData.
+    # Keyed by (file name, dataLocation, dataLen, mtime), so changed files are read again.
+    # Holds at most maxBytes bytes of data; the least recently used data are evicted first.
+    # Cached data are made read-only, since they are shared by all callers.
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return '<SDF Data Cache : %d of %d bytes>' % (self.nbytes, self.maxBytes)
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if data.nbytes > self.maxBytes:
+            return
+        data.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.maxBytes:
+                evictedKey, evictedData = self.entries.popitem(last = False)
+                self.nbytes -= evictedData.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'nbytes': self.nbytes, 'maxBytes': self.maxBytes}
+
+
+# The data cache in use, None if disabled. See enableDataCache.
+dataCache = None
+
+
+def enableDataCache(maxBytes = 1 << 30):
+    # Cache the data read by get() calls of all data objects, up to maxBytes bytes.
+    # Repeated get() calls then return the same read-only arrays without reading the files.
+    global dataCache
+    dataCache = _data_cache(maxBytes)
+    return dataCache
+
+def disableDataCache():
+    global dataCache
+    dataCache = None
+
+def dataCacheInfo():
+    # Returns the statistics of the data cache, or None if it's disabled.
+    if dataCache is None:
+        return None
+    return dataCache.info()
+
+
+class _io_stats(object):
+    # Counts of the I/O on sdf files, kept while profiling (see profileIO).
+    # For each (file name, block type name), counts the opens, seeks, read calls and bytes read,
+    # and the seconds spent in read calls (ioTime), in reading and parsing headers (headerTime),
+    # and in retrieving data (dataTime), which also takes in decoding and reshaping them.
+    # Headers and info areas are counted under the block type name 'header'.
+
+    fields = ('opens', 'seeks', 'reads', 'bytes', 'ioTime', 'headerTime', 'dataTime')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counts = {}
+
+    def __repr__(self):
+        return '<I/O statistics of %d files>' % len(set([fileName for fileName, blockTypeName in self.counts]))
+
+    def count(self, fileName, blockTypeName, **counts):
+        with self.lock:
+            entry = self.counts.get((fileName, blockTypeName))
+            if entry is None:
+                entry = self.counts[(fileName, blockTypeName)] = dict.fromkeys(self.fields, 0)
+            for field, value in counts.items():
+                entry[field] += value
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+
+    def summary(self, by = 'file', fileNames = None):
+        # Returns the counts summed by 'file' or 'blockType', as a dictionary
+        # from file names or block type names to dictionaries of counts,
+        # or summed over everything, as a single dictionary of counts, by 'total'.
+        # Only the files in fileNames are taken if given.
+        if not by in ('file', 'blockType', 'total'):
+            raise ValueError('by should be \'file\', \'blockType\' or \'total\', not %r' % (by,))
+        if fileNames is not None:
+            fileNames = set(fileNames)
+        sums = {}
+        with self.lock:
+            for (fileName, blockTypeName), entry in self.counts.items():
+                if fileNames is not None and not fileName in fileNames:
+                    continue
+                key = {'file': fileName, 'blockType': blockTypeName, 'total': None}[by]
+                if not key in sums:
+                    sums[key] = dict.fromkeys(self.fields, 0)
+                for field in self.fields:
+                    sums[key][field] += entry[field]
+        if by == 'total':
+            return sums.get(None, dict.fromkeys(self.fields, 0))
+        return sums
+
+    def show(self, by = 'blockType', fileNames = None):
+        sums = self.summary(by, fileNames)
+        print '%-40s %8s %8s %8s %12s %10s %10s %10s' % ((by,) + self.fields)
+        for key in sorted(sums):
+            entry = sums[key]
+            print '%-40s %8d %8d %8d %12d %10.4f %10.4f %10.4f' % ((key,) + tuple(entry[field] for field in self.fields))
+
+
+def enableIOStats():
+    # Count the I/O on sdf files from now on, see _io_stats.
+    global ioStats
+    ioStats = _io_stats()
+    return ioStats
+
+def disableIOStats():
+    global ioStats
+    ioStats = None
+
+def ioStatsInfo(by = 'file'):
+    # Returns the I/O statistics summed by 'file', 'blockType' or 'total', or None if not profiling.
+    if ioStats is None:
+        return None
+    return ioStats.summary(by)
+
+class _future(object):
+    # The result of an asynchronous call (see submitAsync), to be available later.
+    # Has the methods of concurrent.futures.Future used for waiting and callbacks,
+    # but isn't one, so eg. asyncio.wrap_future doesn't accept it.
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def __repr__(self):
+        if not self.done():
+            return '<Future pending>'
+        if self.error is not None:
+            return '<Future raised %r>' % (self.error,)
+        return '<Future done>'
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout = None):
+        # Wait for the call to finish, and return its result or raise its error.
+        if not self.event.wait(timeout):
+            raise RuntimeError('timed out waiting for the result')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout = None):
+        if not self.event.wait(timeout):
+            raise RuntimeError('timed out waiting for the result')
+        return self.error
+
+    def add_done_callback(self, fn):
+        # Call fn(self) once done, at once if already done.
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self, value, error):
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print 'Warning: callback %r of %r raised %r' % (fn, self, e)
+
+
+# The pool of threads running the asynchronous calls, created on first use, and the
+# futures of the calls in progress, by key, so that concurrent calls of the same are shared.
+asyncPool = None
+asyncPending = {}
+asyncLock = threading.Lock()
+
+
+def setAsyncWorkers(workers):
+    # Change the number of threads doing asynchronous calls.
+    # Calls already submitted are finished by the old threads.
+    global asyncPool, asyncWorkers
+    with asyncLock:
+        oldPool, asyncPool = asyncPool, None
+        asyncWorkers = workers
+    if oldPool is not None:
+        oldPool.close()
+
+def submitAsync(key, func, callback = None):
+    # Run func() in the asynchronous executor, and return a future of its result.
+    # While a call of the same key is in progress, its future is returned instead,
+    # so that eg. many clients asking for the same data share one read.
+    global asyncPool
+    with asyncLock:
+        future = asyncPending.get(key)
+        if future is None:
+            future = asyncPending[key] = _future()
+            if asyncPool is None:
+                from multiprocessing.pool import ThreadPool
+
+                asyncPool = ThreadPool(asyncWorkers)
+
+            def run():
+                value, error = None, None
+                try:
+                    value = func()
+                except Exception as e:
+                    error = e
+                with asyncLock:
+                    del asyncPending[key]
+                future.finish(value, error)
+
+            asyncPool.apply_async(run)
+    if callback is not None:
+        future.add_done_callback(callback)
+    return future
+
+def aopen_dir(wd = '.', callback = None, **kwargs):
+    # Asynchronous d(): returns at once a future of the sdf file collection,
+    # with the headers of all its files already parsed, so that searching it doesn't block.
+    # kwargs are passed to d(). Concurrent calls with the same arguments share the collection.
+    def openDir():
+        dataSet = d(wd, **kwargs)
+        for sdfFile in dataSet:
+            sdfFile.load()
+        dataSet.flushMetadataCache()
+        return dataSet
+
+    key = ('d', repr(wd), repr(sorted(kwargs.items())))
+    return submitAsync(key, openDir, callback)
+
+
+@contextlib.contextmanager
+def profileIO():
+    # Count the I/O on sdf files within a with statement, eg.
+    #     with sdf.profileIO() as stats:
+    #         D.sd('ex').stack()
+    #     stats.show()
+    # The statistics kept before, if any, are put back afterwards.
+    global ioStats
+    previous = ioStats
+    ioStats = _io_stats()
+    try:
+        yield ioStats
+    finally:
+        ioStats = previous
+
+def d(wd = '.', mmap = False, metadata_cache = False, workers = None,
+        read_workers = None, read_chunk_bytes = None):
+    dataSet = _d(wd, mmap = mmap, metadata_cache = metadata_cache, workers = workers,
+            read_workers = read_workers, read_chunk_bytes = read_chunk_bytes)
     for estr in dataSet.errorStrings:
         print 'Error:', estr
-    for wstr in dataSet.warningStrings:
-        print 'Warning:', wstr
+    dataSet.showWarnings()
     return dataSet
 
 def pathSeparator():
     return '/'
 
+def stripNull(s):
+    # Strip the padding of a string from sdf file.
+    return s.rstrip('\x00').strip()
+
 
 if __name__ == '__main__':
     print 'Please import this module from python.'
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Benchmarks of sdf.py, on synthetic sdf files.
+# The files are written by writeSDF, with the header and block layouts that sdf.py parses,
+# so that runs can be repeated and compared across versions and I/O modes.
+#
+# Usage: python sdf_bench.py [--files 8] [--grid 128,128,64] [--particles 1000000] ...
+# See python sdf_bench.py --help.
+# The files are read through the page cache, so the numbers are for warm reads,
+# unless the cache is dropped between runs.
+
+import os, sys, time, shutil, tempfile, resource, argparse
+import numpy as np
+
+import sdf
+
+
+# Names and staggers of the field variables written, in order.
+# Further variables are named var<N>, and are cell centred.
+FIELD_VARIABLES = [('ex', 1), ('ey', 2), ('ez', 4), ('bx', 6), ('by', 5), ('bz', 3)]
+
+# Point variables written for each species.
+SPECIES_VARIABLES = ['px', 'py', 'pz', 'weight']
+
+SDF_DATATYPE_FOR_DTYPE = {'f4': 3, 'f8': 4, 'i4': 1, 'i8': 2}
+
+
+def padString(s, n):
+    return s + ' ' * (n - len(s))
+
+
+def writeSDF(fileName, step = 0, simTime = 0.0, grid = (32, 32, 16), variables = 6, dtype = 'f8',
+        particles = 10000, species = ('electron',), summary = True, seed = 0):
+    # Write a synthetic sdf file.
+    # It holds a run_info block, a plain mesh of grid cells, the given number of plain variables
+    # on it, and for each species a point mesh of the given number of particles and its variables.
+    # grid is given in Fortran order, ie. (nx, ny, nz), and can have 1 to 3 dimensions.
+    # With summary False, no summary section is written, so the block chain is followed on reading.
+    # Returns the size of the file.
+
+    rng = np.random.RandomState(seed + step)
+    dataType = SDF_DATATYPE_FOR_DTYPE[dtype]
+    ndims = len(grid)
+    idLen, stringLen = sdf.idLen, sdf.stringLen
+    blocks = []
+
+    def addBlock(blockID, blockName, blockType, dataType, ndims, info, data):
+        blocks.append((blockID, blockName, blockType, dataType, ndims, info, data))
+
+    def idStrings(strings):
+        return ''.join(padString(s, idLen) for s in strings)
+
+    runInfo = sdf.sdfStruct('2i%ds' % (4 * stringLen)).pack(1, 0,
+            ''.join(padString(s, stringLen) for s in ('sdf_bench', 'synthetic', 'localhost', '')))
+    runInfo += sdf.sdfStruct('q4i').pack(0, 0, 0, 0, 0)
+    addBlock('run_info', 'Run_info', 7, 0, 0, runInfo, '')
+
+    dims = tuple(n + 1 for n in grid)
+    labels = 'XYZ'[:ndims]
+    meshInfo = sdf.sdfStruct('%dd' % ndims).pack(*([1.0] * ndims)) + idStrings(labels) + idStrings(['m'] * ndims)
+    meshInfo += sdf.sdfStruct('i%dd%dd%di' % (ndims, ndims, ndims)).pack(*([1] + [0.0] * ndims + [1.0] * ndims + list(dims)))
+    meshData = np.concatenate([np.linspace(0.0, 1.0, n) for n in dims]).astype('f8')
+    addBlock('grid', 'Grid/Grid', 1, 4, ndims, meshInfo, meshData.tostring())
+
+    shapeC = tuple(reversed(grid))
+    for i in range(variables):
+        if i < len(FIELD_VARIABLES):
+            blockID, stagger = FIELD_VARIABLES[i]
+        else:
+            blockID, stagger = 'var%d' % i, 0
+        info = sdf.sdfStruct('d%ds%ds%dii' % (idLen, idLen, ndims)).pack(1.0,
+                padString('V/m', idLen), padString('grid', idLen), *(list(grid) + [stagger & ((1 << ndims) - 1)]))
+        data = rng.rand(*shapeC).astype(dtype)
+        addBlock(blockID, 'Fields/' + blockID, 3, dataType, ndims, info, data.tostring())
+
+    for speciesName in species:
+        meshID = 'grid/' + speciesName
+        info = sdf.sdfStruct('%dd' % ndims).pack(*([1.0] * ndims)) + idStrings(labels) + idStrings(['m'] * ndims)
+        info += sdf.sdfStruct('i%dd%ddq' % (ndims, ndims)).pack(*([1] + [0.0] * ndims + [1.0] * ndims + [particles]))
+        info += padString(speciesName, idLen)
+        addBlock(meshID, 'Grid/Particles/' + speciesName, 2, 4, ndims, info, rng.rand(ndims, particles).tostring())
+        for variable in SPECIES_VARIABLES:
+            info = sdf.sdfStruct('d%ds%dsq%ds' % (idLen, idLen, idLen)).pack(1.0,
+                    padString('kg.m/s', idLen), padString(meshID, idLen), particles, padString(speciesName, idLen))
+            data = rng.rand(particles).astype(dtype)
+            addBlock(variable + '/' + speciesName, 'Particles/' + variable + '/' + speciesName,
+                    4, dataType, 1, info, data.tostring())
+
+    headerLength = sdf.SDF_HEADER_STRUCT.size
+    blockHeaderLength = sdf.SDF_BLOCK_HEADER_STRUCT.size
+    locations = []
+    location = headerLength
+    for block in blocks:
+        locations.append(location)
+        location += blockHeaderLength + len(block[5]) + len(block[6])
+
+    f = open(fileName, 'wb')
+    f.write('\0' * headerLength)
+    summaryParts = []
+    for i, (blockID, blockName, blockType, blockDataType, blockDims, info, data) in enumerate(blocks):
+        if i + 1 < len(blocks):
+            nextLocation = locations[i + 1]
+        else:
+            nextLocation = location
+        blockHeader = sdf.SDF_BLOCK_HEADER_STRUCT.pack(nextLocation, locations[i] + blockHeaderLength + len(info),
+                padString(blockID, idLen), len(data), blockType, blockDataType, blockDims,
+                padString(blockName, stringLen), len(info))
+        f.write(blockHeader + info + data)
+        summaryParts.append(blockHeader + info)
+    summaryLocation, summarySize = 0, 0
+    if summary:
+        summaryLocation, summarySize = location, sum(len(s) for s in summaryParts)
+        f.write(''.join(summaryParts))
+    # The header is written last, as EPOCH does on closing the file.
+    f.seek(0)
+    f.write(sdf.SDF_HEADER_STRUCT.pack('SDF1', 16911887, 1, 1, padString('sdf_bench', 32), headerLength,
+            summaryLocation, summarySize, len(blocks), blockHeaderLength, step, simTime,
+            0, 0, stringLen, 1, 0, 0))
+    f.close()
+    return os.path.getsize(fileName)
+
+
+def writeDataset(dirName, files, **kwargs):
+    # Write files synthetic sdf files into dirName, with the options of writeSDF.
+    # Returns the total size of the files.
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName)
+    totalSize = 0
+    for i in range(files):
+        totalSize += writeSDF(os.path.join(dirName, '%04d.sdf' % i), step = i * 100, simTime = i * 1e-15, **kwargs)
+    return totalSize
+
+
+def maxRSS():
+    # Peak resident set size of this process, in MB.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024.0 ** 2
+    return rss / 1024.0
+
+
+def timed(func, repeat):
+    # Run func repeat times. Returns the best time, and the result of func,
+    # which is the number of bytes (or items) processed.
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def report(name, seconds, amount, unit):
+    if unit == 'B':
+        rate = '%10.1f MB/s' % (amount / 1024.0 ** 2 / max(seconds, 1e-9))
+    else:
+        rate = '%10.1f %s/s' % (amount / max(seconds, 1e-9), unit)
+    print '%-48s %10.4f s %s %10.1f MB peak RSS' % (name, seconds, rate, maxRSS())
+
+
+def touch(data):
+    # Reduce the data, so that memory mapped data are actually read. Returns their size in bytes.
+    data = np.asarray(data)
+    data.sum()
+    return data.nbytes
+
+
+def benchOpen(dirName, repeat):
+    # Opening the directory, and parsing the headers of all files by the first sd().
+
+    def openDir(**kwargs):
+        def run():
+            D = sdf.d(dirName, **kwargs)
+            return len(D.sd())
+        return run
+
+    report('open + sd()', *(timed(openDir(), repeat) + ('blocks',)))
+    report('open + sd(), 4 workers', *(timed(openDir(workers = 4), repeat) + ('blocks',)))
+    cacheFileName = os.path.join(dirName, sdf.metadataCacheName)
+    if os.path.exists(cacheFileName):
+        os.remove(cacheFileName)
+    report('open + sd(), metadata cache cold', *(timed(openDir(metadata_cache = True), 1) + ('blocks',)))
+    report('open + sd(), metadata cache warm', *(timed(openDir(metadata_cache = True), repeat) + ('blocks',)))
+    os.remove(cacheFileName)
+
+
+def benchQueries(D, repeat):
+    # Searches of the blocks, by ID and by other keys.
+
+    queries = [('ex',), ('ex', 'ey', 'ez'), ('grid/electron',)]
+
+    def byID():
+        D.allData = None
+        count = 0
+        for i in range(10):
+            for query in queries:
+                count += len(D.sd(*query))
+        return count
+
+    def byType():
+        count = 0
+        for i in range(10):
+            count += len(D.sd(blockTypeName = 'SDF_BLOCKTYPE_PLAIN_VARIABLE'))
+            count += len(D.sd(blockTypeName = 'SDF_BLOCKTYPE_POINT_VARIABLE'))
+        return count
+
+    report('sd() by block ID', *(timed(byID, repeat) + ('results',)))
+    report('sd() by block type', *(timed(byType, repeat) + ('results',)))
+
+
+def benchReads(D, mode, repeat):
+    # Full reads, slice reads and particle chunk iteration, in the I/O mode D was opened with.
+
+    plainData = D.sd(blockTypeName = 'SDF_BLOCKTYPE_PLAIN_VARIABLE')
+    meshes = D.sd(blockTypeName = 'SDF_BLOCKTYPE_POINT_MESH')
+
+    def fullGet():
+        size = 0
+        for dataObj in plainData:
+            size += touch(dataObj.get())
+        return size
+
+    def sliceGet():
+        # A plane across the slowest axis, and a strided subvolume.
+        size = 0
+        for dataObj in plainData:
+            shape = dataObj.dataShape()
+            size += touch(dataObj[shape[0] // 2])
+            size += touch(dataObj[tuple(slice(None, None, 4) for n in shape)])
+        return size
+
+    def particleChunks():
+        size = 0
+        for dataObj in meshes:
+            for coords, values in dataObj.iter_chunks(1 << 16, SPECIES_VARIABLES):
+                size += touch(coords) + sum(touch(v) for v in values)
+        return size
+
+    report('get(), %s' % mode, *(timed(fullGet, repeat) + ('B',)))
+    report('slices, %s' % mode, *(timed(sliceGet, repeat) + ('B',)))
+    report('particle chunks, %s' % mode, *(timed(particleChunks, repeat) + ('B',)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmarks of sdf.py on synthetic sdf files.')
+    parser.add_argument('--dir', help = 'directory for the files, a temporary one by default')
+    parser.add_argument('--keep', action = 'store_true', help = 'keep the files, and reuse them if present')
+    parser.add_argument('--files', type = int, default = 8)
+    parser.add_argument('--grid', default = '64,64,32', help = 'cells along each axis, eg. 64,64,32')
+    parser.add_argument('--variables', type = int, default = 6)
+    parser.add_argument('--dtype', default = 'f8', choices = sorted(SDF_DATATYPE_FOR_DTYPE.keys()))
+    parser.add_argument('--particles', type = int, default = 200000)
+    parser.add_argument('--species', type = int, default = 1)
+    parser.add_argument('--no-summary', action = 'store_true', help = 'write files without summary sections')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'the best of how many runs is reported')
+    args = parser.parse_args(argv)
+
+    # Only what the script creates is removed afterwards: the temporary directory,
+    # or else the files written into the given one.
+    dirName = args.dir
+    tempDir = dirName is None
+    if tempDir:
+        dirName = tempfile.mkdtemp(prefix = 'sdf_bench_')
+    newDir = not os.path.isdir(dirName)
+    writtenFiles = []
+    grid = tuple(int(n) for n in args.grid.split(','))
+    # Read ranges of an eighth of a variable, so that a full read is split among the read workers.
+    variableBytes = int(np.prod(grid)) * np.dtype(args.dtype).itemsize
+    readChunkBytes = max(1 << 12, variableBytes // 8)
+    species = ['electron'] + ['species%d' % i for i in range(1, args.species)]
+
+    try:
+        if args.keep and os.path.isdir(dirName) and os.listdir(dirName) != []:
+            totalSize = sum(os.path.getsize(os.path.join(dirName, f)) for f in os.listdir(dirName))
+            print 'Reusing %s' % dirName
+        else:
+            start = time.time()
+            writtenFiles = [os.path.join(dirName, '%04d.sdf' % i) for i in range(args.files)]
+            totalSize = writeDataset(dirName, args.files, grid = grid, variables = args.variables,
+                    dtype = args.dtype, particles = args.particles, species = species,
+                    summary = not args.no_summary)
+            print 'Wrote %d files, %.1f MB, into %s in %.2f s' % (args.files, totalSize / 1024.0 ** 2,
+                    dirName, time.time() - start)
+
+        benchOpen(dirName, args.repeat)
+        D = sdf.d(dirName)
+        benchQueries(D, args.repeat)
+        benchReads(D, 'read', args.repeat)
+        benchReads(sdf.d(dirName, mmap = True), 'mmap', args.repeat)
+        benchReads(sdf.d(dirName, read_workers = 4, read_chunk_bytes = readChunkBytes),
+                '4 read workers, %d kB ranges' % (readChunkBytes // 1024), args.repeat)
+        sdf.enableDataCache()
+        try:
+            benchReads(sdf.d(dirName), 'data cache', args.repeat)
+        finally:
+            sdf.disableDataCache()
+    finally:
+        if not args.keep:
+            if tempDir:
+                shutil.rmtree(dirName)
+            else:
+                for fileName in writtenFiles:
+                    if os.path.exists(fileName):
+                        os.remove(fileName)
+                if newDir and os.listdir(dirName) == []:
+                    os.rmdir(dirName)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])